@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''Benchmarks the client against a local fake Catch API server.
+
+    python bench_catchapi.py --notes 5000 --latency 0.005 --output new.json
+    python bench_catchapi.py --compare old.json
+    python bench_catchapi.py --codec json --compare new.json decode import
+
+Results are written as JSON, one entry per benchmark, so runs of different
+versions can be compared with --compare.
+'''
+
+import optparse, platform, StringIO, subprocess, sys, time
+import simplejson as json
+
+import catchapi
+from fake_catchapi import FakeCatchServer
+
+BENCHMARKS = []
+
+def benchmark(unit):
+    def register(fn):
+        BENCHMARKS.append((fn.__name__[len('bench_'):], unit, fn))
+        return fn
+    return register
+
+@benchmark('logins')
+def bench_login(session, opts):
+    for i in range(opts.repeat * 10):
+        session.login("bench", "bench")
+    return opts.repeat * 10
+
+@benchmark('notes')
+def bench_get_note(session, opts):
+    user = session.login("bench", "bench")
+    ids = [n['id'] for n in user.get_notes(0, opts.repeat * 10, full=False)[0]]
+    for id in ids:
+        user.get_note(id)
+    return len(ids)
+
+@benchmark('notes')
+def bench_paginate(session, opts):
+    user = session.login("bench", "bench")
+    count = 0
+    for i in range(opts.repeat):
+        for note in user.iter_notes(page_size=opts.page_size):
+            count += 1
+    return count
+
+@benchmark('notes')
+def bench_paginate_stream(session, opts):
+    user = session.login("bench", "bench")
+    count = 0
+    for i in range(opts.repeat):
+        for note in user.iter_notes(page_size=opts.page_size, stream=True):
+            count += 1
+    return count
+
+@benchmark('notes')
+def bench_bulk_post(session, opts):
+    user = session.login("bench", "bench")
+    texts = ["bulk %d" % i for i in range(opts.bulk)]
+    opts.posted = [r.result for r in user.post_notes(texts, concurrency=opts.concurrency)]
+    return len(opts.posted)
+
+@benchmark('notes')
+def bench_bulk_edit(session, opts):
+    user = session.login("bench", "bench")
+    edits = [(note, {'text': note['text'] + " edited"}) for note in opts.posted]
+    return sum(1 for r in user.edit_notes(edits, concurrency=opts.concurrency) if r.error is None)
+
+@benchmark('notes')
+def bench_bulk_delete(session, opts):
+    user = session.login("bench", "bench")
+    return sum(1 for r in user.delete_notes(opts.posted, concurrency=opts.concurrency)
+               if r.error is None)
+
+@benchmark('bytes')
+def bench_upload(session, opts):
+    user = session.login("bench", "bench")
+    note = user.post_note("upload")
+    data = "\0" * opts.media_size
+    for i in range(opts.repeat):
+        note.add_media(StringIO.StringIO(data))
+    return opts.repeat * opts.media_size
+
+@benchmark('bytes')
+def bench_download(session, opts):
+    user = session.login("bench", "bench")
+    note = user.post_note("download")
+    media = note.add_media(StringIO.StringIO("\0" * opts.media_size))
+    for i in range(opts.repeat):
+        media.download(StringIO.StringIO())
+    return opts.repeat * opts.media_size
+
+@benchmark('notes')
+def bench_decode(session, opts):
+    user = session.login("bench", "bench")
+    notes, count = user.get_notes(0, opts.page_size)
+    payload = session.codec.dumps({'notes': notes, 'count': count})
+    for i in range(opts.repeat * 100):
+        session.codec.loads(payload)
+    return opts.repeat * 100 * len(notes)
+
+@benchmark('imports')
+def bench_import(session, opts):
+    # each in a fresh interpreter, less the time it takes to start one
+    command = [sys.executable, "-c", "import time; t = time.time(); import catchapi; print time.time() - t"]
+    return opts.repeat * 3, sum(float(subprocess.check_output(command)) for i in range(opts.repeat * 3))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(fn, unit, session, server, opts):
+    events = []
+    session.add_hook('post_request', events.append)
+    requests = server.requests
+    started = time.time()
+    try:
+        items = fn(session, opts)
+    finally:
+        elapsed = time.time() - started
+        session.remove_hook('post_request', events.append)
+    if isinstance(items, tuple):
+        # the benchmark timed itself
+        items, elapsed = items
+    latencies = [e.total for e in events]
+    return {
+        'unit': unit,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_second': items / elapsed if elapsed else 0.0,
+        'requests': server.requests - requests,
+        'errors': sum(1 for e in events if e.error is not None or e.status >= 400),
+        'bytes_sent': sum(e.bytes_sent for e in events),
+        'bytes_received': sum(e.bytes_received for e in events),
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies or [0.0]),
+        },
+    }
+
+def compare(old, new, out):
+    """
+    Prints how each benchmark's throughput and p99 latency changed from the
+    results in ``old`` to those in ``new``.
+    """
+    out.write("%-18s %14s %14s %8s %10s %10s %8s\n" % (
+        "benchmark", "old/s", "new/s", "change", "old p99", "new p99", "change"))
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a, b = old['results'][name], new['results'][name]
+        rate = (b['items_per_second'] / a['items_per_second'] - 1) * 100 if a['items_per_second'] else 0
+        p99 = (b['latency']['p99'] / a['latency']['p99'] - 1) * 100 if a['latency']['p99'] else 0
+        out.write("%-18s %14.1f %14.1f %+7.1f%% %9.2fms %9.2fms %+7.1f%%\n" % (
+            name, a['items_per_second'], b['items_per_second'], rate,
+            a['latency']['p99'] * 1000, b['latency']['p99'] * 1000, p99))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--notes", type="int", default=1000, help="notes in the fake account")
+    parser.add_option("--payload", type="int", default=200, help="characters of text per note")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added to every response")
+    parser.add_option("--jitter", type="float", default=0.0, help="up to this many more seconds")
+    parser.add_option("--repeat", type="int", default=3, help="times to repeat each benchmark")
+    parser.add_option("--page-size", type="int", default=100)
+    parser.add_option("--bulk", type="int", default=200, help="notes posted, edited and deleted")
+    parser.add_option("--concurrency", type="int", default=8)
+    parser.add_option("--media-size", type="int", default=1024 * 1024, help="bytes per upload")
+    parser.add_option("--no-compression", dest="compression", action="store_false", default=True,
+                      help="neither ask for nor send compressed bodies")
+    parser.add_option("--codec", help="JSON module to use, by default the fastest installed")
+    parser.add_option("--output", "-o", help="write the results to this file instead of stdout")
+    parser.add_option("--compare", help="compare the results with those in this file")
+    opts, names = parser.parse_args(argv)
+
+    server = FakeCatchServer(opts.notes, opts.payload, opts.latency, opts.jitter).start()
+    session = catchapi.CatchSession(server.url, pool_size=opts.concurrency,
+                                    compression=opts.compression, compress_requests=opts.compression,
+                                    codec=opts.codec)
+    opts.posted = []
+    opts.codec = session.codec.name
+    results = {}
+    try:
+        for name, unit, fn in BENCHMARKS:
+            if names and name not in names:
+                continue
+            results[name] = run(fn, unit, session, server, opts)
+            sys.stderr.write("%-18s %12.1f %s/s  p99 %.2fms\n" % (
+                name, results[name]['items_per_second'], unit, results[name]['latency']['p99'] * 1000))
+    finally:
+        session.close()
+        server.stop()
+
+    report = {
+        'version': catchapi.__version__,
+        'python': platform.python_version(),
+        'started': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'config': dict((k, getattr(opts, k)) for k in ('notes', 'payload', 'latency', 'jitter', 'repeat',
+                                                       'page_size', 'bulk', 'concurrency', 'media_size',
+                                                       'compression', 'codec')),
+        'results': results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f), report, sys.stderr)
+
+if __name__ == '__main__':
+    main()
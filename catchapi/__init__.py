@@ -17,17 +17,130 @@
 __author__ = 'ariel@catch.com'
 __version__ = '0.5'
 
-import mimetypes, base64, httplib, urllib, os, sys, urlparse, datetime
-import simplejson as json
+import os, sys, urlparse, datetime, errno
+import collections, contextlib, copy, itertools, random, select, socket, threading, time, zlib, Queue
+
+class _LazyModule(object):
+    """
+    Stands in for a module that is only imported once one of its
+    attributes is first used, to keep ``import catchapi`` quick.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = __import__(self._name)
+        return getattr(self._module, attr)
+
+base64 = _LazyModule('base64')
+hashlib = _LazyModule('hashlib')
+httplib = _LazyModule('httplib')
+mimetypes = _LazyModule('mimetypes')
+shutil = _LazyModule('shutil')
+tempfile = _LazyModule('tempfile')
+urllib = _LazyModule('urllib')
+
+class JSONCodec(object):
+    """
+    Encodes and decodes JSON with the module ``name``, such as "json",
+    "simplejson" or "ujson", which is imported when the codec is first
+    used.  Any object with the same ``loads``, ``dumps`` and ``decoder``
+    methods can be used as a session's codec instead.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+
+    def __repr__(self):
+        return "JSONCodec(%r)" % self.name
+
+    @property
+    def module(self):
+        if self._module is None:
+            self._module = __import__(self.name)
+        return self._module
+
+    def loads(self, data):
+        return self.module.loads(data)
+
+    def dumps(self, obj, **kwds):
+        """
+        Encodes ``obj``, compactly unless ``kwds`` say otherwise.
+        """
+        if hasattr(self.module, 'JSONEncoder') and 'indent' not in kwds:
+            kwds.setdefault('separators', (',', ':'))
+        return self.module.dumps(obj, **kwds)
+
+    def decoder(self):
+        """
+        Returns a decoder whose ``raw_decode(s, index)`` reads one value
+        starting at ``index``, for decoding streamed responses.  Modules
+        without one borrow it from the fastest that has one.
+        """
+        if hasattr(self.module, 'JSONDecoder'):
+            return self.module.JSONDecoder()
+        return json_codec(streaming=True).decoder()
+
+# JSON modules by how fast they decode, fastest first
+JSON_BACKENDS = ('ujson', 'simplejson', 'json')
+
+_codecs = {}
+
+def json_codec(name=None, streaming=False):
+    """
+    Returns the JSONCodec for the module ``name``, or if that is None for
+    the fastest of JSON_BACKENDS that is installed (and that can decode
+    streamed responses, if ``streaming`` is true).  simplejson is passed
+    over when it was installed without its C speedups, which make it
+    faster than the standard library's json.
+    """
+    key = (name, streaming)
+    if key not in _codecs:
+        if name is not None:
+            codec = JSONCodec(name)
+        else:
+            for backend in JSON_BACKENDS:
+                codec = JSONCodec(backend)
+                try:
+                    module = codec.module
+                except ImportError:
+                    continue
+                if streaming and not hasattr(module, 'JSONDecoder'):
+                    continue
+                if backend == 'simplejson' and getattr(module.scanner, 'c_make_scanner', None) is None:
+                    continue
+                break
+        _codecs[key] = codec
+    return _codecs[key]
+
+def _parse_timestamp(value):
+    """
+    Parses the API's timestamps, as in "2011-04-05T22:41:22.123Z", several
+    times faster than strptime does.
+    """
+    if len(value) == 24 and value[4] == '-' and value[10] == 'T' and value[19] == '.' and value[23] == 'Z':
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                                 int(value[20:23]) * 1000)
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
 
 class User(dict):
     """
     A class representing the User structure used by the Catch API.
     """
 
+    # how long, in seconds, the tag list is reused before it is fetched again
+    tags_ttl = 60
+
     def __init__(self, session, *args, **kwds):
         super(User, self).__init__(*args, **kwds)
         self._session = session
+        self._tags = None
+        self._tags_fetched = 0
 
     @property
     def access_token(self):
@@ -35,205 +148,2007 @@ class User(dict):
 
     @property
     def tags(self):
+        """
+        The user's tags.  The list is fetched at most once every ``tags_ttl``
+        seconds, and again after a note write that adds or removes tags.
+        """
+        if self._tags is None or time.time() - self._tags_fetched >= self.tags_ttl:
+            self.refresh_tags()
+        return self._tags
+
+    def refresh_tags(self):
+        fetched = time.time()
         data = self._session._request("GET", '/v1/tags.json', body={'access_token': self.access_token})
-        for tag in data['tags']:
-            tag['modified'] = datetime.datetime.strptime(tag['modified'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        return tuple(data['tags'])
+        self._tags = tuple(dict(tag, modified=_parse_timestamp(tag['modified'])) for tag in data['tags'])
+        self._tags_fetched = fetched
+        return self._tags
+
+    def _tags_changed(self, before, after):
+        # ``before`` is None when a note's tags weren't known
+        if before is None or set(before) != set(after or ()):
+            self._tags = None
 
     def post_note(self, text, **kwds):
         params = {"text": text}
         params.update(kwds)
-        data = self._session._request("POST",
-                                      "/v2/notes.json?access_token=%s" % self.access_token,
-                                      body=params)
-        return Note(self, self._session, data['notes'][0])
+        data = self._session._request("POST", "/v2/notes.json?access_token={token}",
+                                      body=params, path={'token': self.access_token})
+        note = Note(self, self._session, data['notes'][0])
+        self._session._invalidate(note['id'])
+        self._tags_changed((), note.get('tags'))
+        self._session._notify('notes', [note])
+        return note
 
     def get_note(self, id):
-        data = self._session._request("GET",
-                                      "/v2/notes/%s.json" % id,
-                                      body={"access_token": self.access_token})
-        return Note(self, self._session, data['notes'][0])
+        data = self._session._request("GET", "/v2/notes/{id}.json",
+                                      body={"access_token": self.access_token}, path={'id': id})
+        note = Note(self, self._session, data['notes'][0])
+        self._session._notify('notes', [note])
+        return note
 
     @property
     def notes(self):
-        class NoteIterator:
-            def __init__(self, user):
-                self._user = user
-                self._offset = 0
-                self._limit = 100
-                self._count = -1
-                self._next_batch()
-
-            def __len__(self): return self._count
-            def __iter__(self): return self
-
-            def next(self):
-                if not self._data:
-                    self._next_batch()
-                return Note(self, self._user._session, self._data.pop(0))
-
-            def _next_batch(self):
-                if self._count == 0 or (self._count >= 0 and self._offset > self._count):
-                    raise StopIteration
-                limit = min(self._count - self._offset, self._limit) if self._count >= 0 else self._limit
-                self._data, self._count = self._user.get_notes(offset=self._offset, limit=limit)
-                self._offset += self._limit
-
-        return NoteIterator(self)
-
-    def get_notes(self, offset=0, limit=20):
+        return self.iter_notes()
+
+    def iter_notes(self, page_size=100, prefetch=2, full=True, stream=False, with_comments=False):
+        """
+        Returns a NoteIterator over all of the user's notes, requesting pages of
+        ``page_size`` notes and keeping up to ``prefetch`` of them in flight.
+        With ``with_comments=True`` each note comes with its comments loaded.
+        """
+        return NoteIterator(self, page_size, prefetch, full, stream, with_comments)
+
+    def stream_notes(self, offset=0, limit=100, full=True):
+        """
+        Like get_notes, but returns a NoteStream that decodes each note as
+        soon as it has been received.
+        """
+        source = self._session._request(
+            "GET", "/v2/notes.json",
+            body={"offset": offset, "limit": limit, 'full': 'true' if full else 'false',
+                  'access_token': self.access_token},
+            stream='notes')
+        return NoteStream(self, source, None if full else _Hydrator(self, offset, limit))
+
+    def get_notes(self, offset=0, limit=20, full=True, with_comments=False):
+        """
+        Returns a page of notes and the total number of notes.  With
+        ``full=False`` the server sends only a summary of each note, and the
+        notes are SummaryNotes that fetch the rest when it is asked for.  With
+        ``with_comments=True`` every note's comments are fetched too.
+        """
         data = self._session._request("GET", "/v2/notes.json",
-                                      body={"offset": offset, "limit": limit, 'full': 'true',
+                                      body={"offset": offset, "limit": limit,
+                                            'full': 'true' if full else 'false',
                                             'access_token': self.access_token})
-        return [Note(self, self._session, n) for n in data['notes']], data['count']
+        if full and self._session.cache is not None:
+            self._session.cache.observe_notes(self.access_token, data['notes'])
+        if full:
+            notes = [Note(self, self._session, n) for n in data['notes']]
+        else:
+            hydrator = _Hydrator(self, offset, limit)
+            notes = [hydrator.add(SummaryNote(self, self._session, n, hydrator)) for n in data['notes']]
+        if with_comments:
+            # listeners hear of the comments along with the notes below
+            self._prefetch_comments(notes, 8, notify=not full)
+        if full:
+            self._session._notify('notes', notes)
+        return notes, data['count']
+
+    def count_notes(self):
+        """
+        Returns how many notes the user has, at the cost of a single summary.
+        """
+        return self.get_notes(0, 1, full=False)[1]
+
+    def prefetch_comments(self, notes, concurrency=8):
+        """
+        Fetches the comments of many notes at once, ``concurrency`` at a time,
+        so that reading the notes' ``comments`` afterwards doesn't wait on the
+        server.  Notes whose comments are already loaded are skipped.
+        """
+        self._prefetch_comments(notes, concurrency)
+
+    def _prefetch_comments(self, notes, concurrency, notify=True):
+        wanted = [n for n in notes if not hasattr(n, '_comments')]
+        if not wanted:
+            return
+        fetched = []
+        for result in self._bulk(Note._fetch_comments, wanted, concurrency, None, False):
+            if result.error is not None:
+                raise result.error
+            result.item._comments = result.result
+            fetched.append(result.item)
+        if notify:
+            self._session._notify('comments', fetched)
+
+    def post_notes(self, notes, concurrency=8, rate=None, ordered=True):
+        """
+        Posts many notes at once.  ``notes`` is an iterable of note texts, or
+        of dicts of keyword arguments for post_note.
+
+        Up to ``concurrency`` notes are posted in parallel, and no more than
+        ``rate`` a second if a rate is given.  Returns an iterator of
+        BulkResult tuples, in the order of ``notes`` if ``ordered`` is true or
+        else as each call completes.  A failed call does not stop the rest:
+        its BulkResult carries the exception in ``error`` instead.  The calls
+        start straight away and are all made whether or not the results are
+        read.
+        """
+        def post(note):
+            if isinstance(note, dict):
+                return self.post_note(**note)
+            return self.post_note(note)
+        return self._bulk(post, notes, concurrency, rate, ordered)
+
+    def edit_notes(self, edits, concurrency=8, rate=None, ordered=True):
+        """
+        Like post_notes, for an iterable of ``(note, changes)`` pairs where
+        ``changes`` is a dict of keyword arguments for Note.edit.
+        """
+        def edit(item):
+            note, changes = item
+            note.edit(**changes)
+            return note
+        return self._bulk(edit, edits, concurrency, rate, ordered)
+
+    def delete_notes(self, notes, concurrency=8, rate=None, ordered=True):
+        """
+        Like post_notes, for an iterable of notes to delete.
+        """
+        def delete(note):
+            note.delete()
+            return note
+        return self._bulk(delete, notes, concurrency, rate, ordered)
+
+    def download_media(self, media, directory, concurrency=4, ordered=True):
+        """
+        Downloads many Media at once into ``directory``, each to a file named
+        after its id and filename, ``concurrency`` at a time.  Returns an
+        iterator of BulkResult tuples whose ``result`` is the downloaded
+        file's path, as post_notes does.
+        """
+        def download(media):
+            name = media['id']
+            if media.get('filename'):
+                name = "%s-%s" % (name, os.path.basename(media['filename']))
+            return media.download(os.path.join(directory, name))
+        return self._bulk(download, media, concurrency, None, ordered)
+
+    def _bulk(self, fn, items, concurrency, rate, ordered):
+        """
+        Calls ``fn`` on every one of ``items`` from a thread of its own,
+        starting now, and returns an iterator of the BulkResults as they
+        come in.
+        """
+        results = Queue.Queue()
+
+        def drive():
+            try:
+                for result in self._run_bulk(fn, items, concurrency, rate, ordered):
+                    results.put(result)
+            except Exception as e:
+                # iterating over ``items`` failed; the reader gets the error
+                results.put(e)
+            else:
+                results.put(None)
+
+        def read():
+            while True:
+                result = results.get()
+                if result is None:
+                    return
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+
+        driver = threading.Thread(target=drive)
+        driver.daemon = True
+        driver.start()
+        return read()
+
+    def _run_bulk(self, fn, items, concurrency, rate, ordered):
+        limiter = RateLimiter(rate) if rate else None
+        workers = _WorkerPool(concurrency)
+        done = Queue.Queue()
+        # bounds both the calls in flight and the results held back for ordering
+        window = concurrency * 2
+
+        def call(index, item):
+            if limiter:
+                limiter.acquire()
+            try:
+                return BulkResult(index, item, fn(item), None)
+            except Exception as e:
+                return BulkResult(index, item, None, e)
+
+        items = iter(items)
+        exhausted = False
+        submitted = outstanding = next_index = 0
+        held = {}
+        try:
+            while True:
+                while not exhausted and outstanding + len(held) < window:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    workers.submit(call, submitted, item).add_done_callback(
+                        lambda f: done.put(f.result()))
+                    submitted += 1
+                    outstanding += 1
+                if not outstanding:
+                    return
+                result = done.get()
+                outstanding -= 1
+                if not ordered:
+                    yield result
+                    continue
+                held[result.index] = result
+                while next_index in held:
+                    yield held.pop(next_index)
+                    next_index += 1
+        finally:
+            workers.shutdown()
+
+class NoteIterator(object):
+    """
+    Iterates over all of a user's notes, one page at a time.
+
+    The first page is fetched up front, which also tells us how many notes
+    there are.  From then on up to ``prefetch`` of the following pages are
+    requested in parallel, by offset, on the session's worker threads while
+    the caller works through the current page.  With ``prefetch=0`` each
+    page is fetched only once the previous one has been used up.
+
+    With ``stream=True`` pages are instead decoded a note at a time as they
+    come off the connection (see NoteStream), and are never prefetched.
+    The note count is then only known, and ``len()`` only works, once the
+    server has sent it.
+
+    With ``with_comments=True`` the comments of each page's notes are
+    fetched along with it; when streaming, they are fetched for batches of
+    notes as they arrive.
+    """
+
+    # notes whose comments are fetched together when streaming
+    comments_batch = 20
+
+    def __init__(self, user, page_size=100, prefetch=2, full=True, stream=False, with_comments=False):
+        self._user = user
+        self._page_size = page_size
+        self._prefetch = 0 if stream else prefetch
+        self._full = full
+        self._with_comments = with_comments
+        self._streaming = stream
+        self._stream = None
+        self._pages = collections.deque()
+        self._count = -1
+        self._offset = 0
+        self._data = self._fetch()
+        self._fill()
+
+    def __len__(self):
+        if self._count < 0 and self._stream:
+            self._count = self._stream.count
+        if self._count < 0:
+            raise TypeError("the note count has not been received yet")
+        return self._count
+
+    def __iter__(self): return self
+
+    def next(self):
+        while True:
+            note = next(self._data, None)
+            if note is not None:
+                return note
+            if self._stream:
+                self._count = self._stream.count
+            if self._pages:
+                notes, self._count = self._pages.popleft().result()
+                self._data = iter(notes)
+            elif self._offset < self._count:
+                self._data = self._fetch()
+            else:
+                raise StopIteration
+            self._fill()
+
+    def _fetch(self):
+        offset = self._offset
+        self._offset += self._page_size
+        if self._streaming:
+            self._stream = self._user.stream_notes(offset, self._page_size, self._full)
+            if self._with_comments:
+                return self._batched_comments(self._stream)
+            return iter(self._stream)
+        notes, self._count = self._user.get_notes(offset, self._page_size, self._full,
+                                                  self._with_comments)
+        return iter(notes)
+
+    def _batched_comments(self, notes):
+        notes = iter(notes)
+        while True:
+            batch = list(itertools.islice(notes, self.comments_batch))
+            if not batch:
+                return
+            self._user.prefetch_comments(batch)
+            for note in batch:
+                yield note
+
+    def _fill(self):
+        while len(self._pages) < self._prefetch and self._offset < self._count:
+            self._pages.append(self._user._session._submit(self._user.get_notes, self._offset,
+                                                           self._page_size, self._full,
+                                                           self._with_comments))
+            self._offset += self._page_size
+
+class NoteStream(object):
+    """
+    A page of notes that are decoded off the connection as they are iterated
+    over, so that only about one note at a time is held in memory.  The
+    total number of notes is in ``count`` once it has been read, which may
+    not be until the last note has been.
+    """
+
+    def __init__(self, user, source, hydrator=None):
+        self._user = user
+        self._source = source
+        self._hydrator = hydrator
+
+    @property
+    def count(self):
+        return self._source.fields.get('count', -1)
+
+    def close(self):
+        self._source.close()
+
+    def __iter__(self):
+        session = self._user._session
+        hydrator = self._hydrator
+        # listeners are told about the whole page of full notes once it has been read
+        seen = [] if session._listeners and hydrator is None else None
+        for data in self._source:
+            if hydrator is None:
+                note = Note(self._user, session, data)
+            else:
+                note = hydrator.add(SummaryNote(self._user, session, data, hydrator))
+            if seen is not None:
+                seen.append(note)
+            yield note
+        if seen:
+            session._notify('notes', seen)
 
 class Media(dict):
 
+    __slots__ = ('_note', '_deleted')
+
     def __init__(self, user, session, note, *args, **kwds):
-        self._user = user
-        self._session = session
         self._note = note
         super(Media, self).__init__(*args, **kwds)
 
+    # the user and session are shared with, and reached through, the note
+    _user = property(lambda self: self._note._user)
+    _session = property(lambda self: self._note._session)
+
     @property
     def deleted(self):
-        return self._deleted
+        return getattr(self, "_deleted", False)
+
+    @property
+    def _src(self):
+        return self.get('src') or "/v2/media/%s/%s" % (self._note['id'], self['id'])
+
+    def download(self, dest, parallel=4, chunk_size=4 * 1024 * 1024, progress=None):
+        """
+        Downloads the media's content to ``dest``, a path or a writable
+        file-like object, writing it out as it arrives.  Returns ``dest``.
+
+        A download to a path is written to ``dest + ".part"`` in byte ranges
+        of ``chunk_size``, ``parallel`` of them at a time, and renamed into
+        place once complete.  If it is interrupted, downloading to the same
+        path again fetches only the missing ranges.  With a session
+        media_cache, content already in it is copied from there instead of
+        being fetched, and downloaded content is added to it.  ``progress``,
+        if given, is called as ``progress(bytes_done, total_bytes)``.
+        """
+        src = self._src
+        url = src
+        split = urlparse.urlsplit(src)
+        if not split.hostname or split.hostname == self._session._api_host:
+            url += "%s%s" % ("&" if split.query else "?",
+                             urllib.urlencode({'access_token': self._user.access_token}))
+        return self._session._download(url, src, dest, parallel, chunk_size, progress)
 
     def delete(self):
-        data = self._session._request("DELETE", "/v2/media/%s/%s.json" % (self._note['id'], self['id']),
-                                      body={"access_token": self._user.access_token})
+        data = self._session._request("DELETE", "/v2/media/{note}/{id}.json",
+                                      body={"access_token": self._user.access_token},
+                                      path={'note': self._note['id'], 'id': self['id']})
         # not quite ready for this...
         # "server_modified_at": self['server_modified_at']})
+        self._session._invalidate(self._note['id'])
         if data['status'] == 'ok':
-            self._note['media'] = (m for m in self._note['media'] if m is not self)
+            self._note['media'] = tuple(m for m in self._note['media'] if m is not self)
             self._deleted = True
             return True
 
 class Comment(dict):
 
+    __slots__ = ('_note', '_deleted')
+
     def __init__(self, user, session, note, *args, **kwds):
-        self._user = user
-        self._session = session
         self._note = note
         super(Comment, self).__init__(*args, **kwds)
 
+    _user = property(lambda self: self._note._user)
+    _session = property(lambda self: self._note._session)
+
     @property
     def deleted(self):
-        return self._deleted
+        return getattr(self, "_deleted", False)
 
     def delete(self):
-        data = self._session._request("DELETE", "/v2/comment/%s.json" % self['id'],
-                                      body={"access_token": self._user.access_token})
+        data = self._session._request("DELETE", "/v2/comment/{id}.json",
+                                      body={"access_token": self._user.access_token},
+                                      path={'id': self['id']})
         # not quite ready for this...
         # "server_modified_at": self['server_modified_at']})
+        self._session._invalidate(self._note['id'])
         if data['status'] == 'ok':
-            self._note['comments'] = (c for c in self._note._comments if c is not self)
+            if hasattr(self._note, '_comments'):
+                self._note._comments = [c for c in self._note._comments if c is not self]
             self._deleted = True
             return True
 
 class Note(dict):
+    """
+    A note, as a dict of the fields sent by the server.
+
+    Notes are kept small so that millions of them can be held at once: they
+    have no instance ``__dict__``, reach their session through their user,
+    and wrap their media and comments only when those are first asked for.
+    """
+
+    __slots__ = ('_user', '_dirty', '_deleted', '_comments')
 
     def __init__(self, user, session, *args, **kwds):
         self._user = user
-        self._session = session
         self._dirty = False
         super(Note, self).__init__(*args, **kwds)
-        self['media'] = (Media(self._user, self._session, self) for m in self['media'])
+
+    _session = property(lambda self: self._user._session)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key == 'media' and type(value) is list:
+            value = tuple(Media(self._user, self._session, self, m) for m in value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key == 'media' and key in self:
+            return self[key]
+        return dict.get(self, key, default)
 
     @property
     def deleted(self):
         return getattr(self, "_deleted", False)
 
+    def _known_tags(self):
+        # None for a summary without its tags, as loading them would fetch its whole page
+        if dict.__contains__(self, 'tags'):
+            return dict.__getitem__(self, 'tags') or ()
+        return None if isinstance(self, SummaryNote) else ()
+
     def delete(self):
-        self._session._request("DELETE", "/v2/notes/%s.json" % self['id'],
+        self._session._request("DELETE", "/v2/notes/{id}.json",
                                body={"access_token": self._user.access_token,
-                                     "server_modified_at": self['server_modified_at']})
+                                     "server_modified_at": self['server_modified_at']},
+                               path={'id': self['id']})
+        self._session._invalidate(self['id'])
         self._deleted = True
+        self._user._tags_changed(self._known_tags(), ())
+        self._session._notify('deleted', [self])
 
     def add_comment(self, **opts):
-        data = self._session._request("POST",
-                                      "/v2/comments/{id}.json?access_token={token}".format(
-                                          id=self['id'],
-                                          token=self._user.access_token),
-                                      body=opts)
+        data = self._session._request("POST", "/v2/comments/{id}.json?access_token={token}",
+                                      body=opts,
+                                      path={'id': self['id'], 'token': self._user.access_token})
+        self._session._invalidate(self['id'])
         return Comment(self._user, self._session, self, data['notes'][0])
 
     @property
     def comments(self):
         if not hasattr(self, "_comments"):
-            data = self._session._request("GET",
-                                          "/v2/comments/{id}.json".format(id=self['id']),
-                                          body={"access_token": self._user.access_token})
-            self._comments = [Comment(self._user, self._session, self, c) for c in data['notes']]
+            self._comments = self._fetch_comments()
+            self._session._notify('comments', [self])
+        elif self._comments and type(self._comments[0]) is dict:
+            # comments decoded from a local store are left unwrapped until now
+            self._comments = [Comment(self._user, self._session, self, c) for c in self._comments]
         return self._comments
 
+    def _fetch_comments(self):
+        data = self._session._request("GET", "/v2/comments/{id}.json",
+                                      body={"access_token": self._user.access_token},
+                                      path={'id': self['id']})
+        return [Comment(self._user, self._session, self, c) for c in data['notes']]
+
     def edit(self, **kwds):
+        """
+        Changes the given fields of the note.  Inside a session's
+        ``write_behind`` block the changes are held back and merged with any
+        others made to the note, to be sent together later.  Raises a
+        ConflictError if the note has changed on the server since it was
+        fetched.
+        """
+        buffer = self._session.edit_buffer
+        if buffer is not None:
+            buffer.edit(self, kwds)
+            return
+        self._edit(kwds)
+
+    def _edit(self, kwds):
         kwds.setdefault('server_modified_at', self['server_modified_at'])
-        data = self._session._request(
-            "POST",
-            "/v2/notes/{id}.json?access_token={token}".format(id=self['id'],
-                                                              token=self._user.access_token),
-            body=kwds)
+        try:
+            data = self._session._request("POST", "/v2/notes/{id}.json?access_token={token}",
+                                          body=kwds,
+                                          path={'id': self['id'], 'token': self._user.access_token})
+        except ConflictError as e:
+            e.note, e.changes = self, kwds
+            raise
+        self._session._invalidate(self['id'])
+        tags = self._known_tags()
         self.update(data['notes'][0])
+        if getattr(self, '_hydrator', None) is not None:
+            # an edited summary comes back whole
+            self._hydrator = None
+        self._user._tags_changed(tags, dict.get(self, 'tags'))
+        self._session._notify('notes', [self])
 
-    def add_media(self, filename, **opts):
-        BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    def add_media(self, filename, progress=None, **opts):
+        """
+        Uploads ``filename``, a path or any readable file-like object such as
+        an open file or an ``mmap``, and attaches it to the note.  The file
+        is streamed from disk a chunk at a time; ``progress``, if given, is
+        called as ``progress(bytes_sent, total_bytes)`` as the upload goes.
+        """
+        if hasattr(filename, 'read'):
+            fileobj, close = filename, False
+            filename = os.path.basename(getattr(fileobj, 'name', '') or 'upload')
+        else:
+            fileobj, close = open(filename, 'rb'), True
+            filename = os.path.basename(filename)
 
-        def multipart(parts):
-            L = []
-            for (key, fn, value) in parts:
-                L.append('--' + BOUNDARY)
-                if fn:
-                    L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, fn))
-                else:
-                    L.append('Content-Disposition: form-data; name="%s"' % key)
-                content_type = mimetypes.guess_type(fn)[0] or 'application/octet-stream'
-                L.append('Content-Type: %s' % content_type)
-                L.append('')
-                L.append(value)
-            L.append('--' + BOUNDARY + '--')
-            L.append('')
-            return '\r\n'.join(L)
-
-        with open(filename) as body:
-            parts = [('data', filename, body.read())]
+        try:
+            parts = [('data', filename, fileobj)]
             parts.extend([(k, None, v) for k, v in opts.iteritems()])
-            body = multipart(parts)
-
-        data = self._session._request(
-            "POST",
-            "/v2/media/{id}.json?access_token={token}".format(id=self['id'],
-                                                              token=self._user.access_token),
-            body=body,
-            headers={'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY})
+            body = MultipartEncoder(parts, progress=progress)
+            data = self._session._request("POST", "/v2/media/{id}.json?access_token={token}",
+                                          body=body,
+                                          headers={'Content-Type': body.content_type},
+                                          path={'id': self['id'], 'token': self._user.access_token})
+        finally:
+            if close:
+                fileobj.close()
+        self._session._invalidate(self['id'])
 
         m = Media(self._user, self._session, self, data)
         self['media'] = tuple(list(self['media']) + [m])
         return m
 
+class SummaryNote(Note):
+    """
+    A note listed with ``full=False``, which holds only the summary fields
+    the server sent, such as ``id`` and ``server_modified_at``.  The first
+    time any other field is asked for, the whole page the note was listed
+    in is fetched in full, and it and the other summaries from that page
+    are filled in at once.  Iterating over the note's keys or values or
+    converting it with ``dict()`` sees only what has been loaded so far;
+    call ``hydrate`` first to load everything.
+    """
+
+    __slots__ = ('_hydrator',)
+
+    def __init__(self, user, session, data, hydrator):
+        super(SummaryNote, self).__init__(user, session, data)
+        self._hydrator = hydrator
+
+    @property
+    def hydrated(self):
+        return self._hydrator is None
+
+    def hydrate(self):
+        """
+        Loads the rest of the note, with the rest of its page, if that
+        hasn't happened yet.
+        """
+        if self._hydrator is not None:
+            self._hydrator.hydrate()
+        return self
+
+    def __getitem__(self, key):
+        if self._hydrator is not None and not dict.__contains__(self, key):
+            self._hydrator.hydrate()
+        return super(SummaryNote, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if self._hydrator is not None and not dict.__contains__(self, key):
+            self._hydrator.hydrate()
+        return super(SummaryNote, self).get(key, default)
+
+    def __contains__(self, key):
+        if self._hydrator is not None and not dict.__contains__(self, key):
+            self._hydrator.hydrate()
+        return dict.__contains__(self, key)
+
+class _Hydrator(object):
+    """
+    Fills in the SummaryNotes listed together in one page, by fetching the
+    page again in full.  Notes that have since moved out of that page are
+    fetched on their own.
+    """
+
+    def __init__(self, user, offset, limit):
+        self.user = user
+        self.offset = offset
+        self.limit = limit
+        self.notes = []
+        self._lock = threading.Lock()
+
+    def add(self, note):
+        self.notes.append(note)
+        return note
+
+    def hydrate(self):
+        """
+        Loads the notes that are still summaries.  If that fails for any
+        reason but a note being gone from the server, the error is raised
+        and the notes not yet loaded are left to be tried again.
+        """
+        with self._lock:
+            if not self.notes:
+                return
+            wanted = dict((n['id'], n) for n in self.notes)
+            full = self.user.get_notes(self.offset, self.limit)[0]
+            for data in full:
+                note = wanted.pop(data['id'], None)
+                if note is not None:
+                    self._fill(note, data)
+            error = None
+            for result in self.user._bulk(self.user.get_note, list(wanted), 8, None, False):
+                if result.error is None:
+                    self._fill(wanted.pop(result.item), result.result)
+                elif isinstance(result.error, NotFoundError):
+                    # gone from the server; there is nothing more to load
+                    wanted.pop(result.item)._hydrator = None
+                elif error is None:
+                    error = result.error
+            self.notes = wanted.values()
+            if error is not None:
+                raise error
+
+    def _fill(self, note, data):
+        for key, value in data.iteritems():
+            if not dict.__contains__(note, key):
+                dict.__setitem__(note, key, dict.__getitem__(data, key))
+        note._hydrator = None
+
+class MultipartEncoder(object):
+    """
+    A multipart/form-data request body that is read from its parts on demand.
+
+    ``parts`` is a list of ``(name, filename, value)`` tuples.  A value may be
+    a string or any seekable object with a ``read`` method; the latter are
+    read a chunk at a time as the body is sent, and their sizes are found by
+    seeking, so ``len()`` gives the Content-Length without buffering anything.
+    """
+
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+
+    def __init__(self, parts, progress=None):
+        self.content_type = 'multipart/form-data; boundary=%s' % self.BOUNDARY
+        self._progress = progress
+        self._segments = []
+        for (key, fn, value) in parts:
+            head = ['--' + self.BOUNDARY]
+            if fn:
+                head.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, fn))
+                head.append('Content-Type: %s' % (mimetypes.guess_type(fn)[0] or 'application/octet-stream'))
+            else:
+                head.append('Content-Disposition: form-data; name="%s"' % key)
+            self._add('\r\n'.join(head) + '\r\n\r\n')
+            if hasattr(value, 'read'):
+                start = value.tell()
+                value.seek(0, 2)
+                self._segments.append((value, start, value.tell() - start))
+                value.seek(start)
+            else:
+                self._add(value.encode('utf-8') if isinstance(value, unicode) else str(value))
+            self._add('\r\n')
+        self._add('--' + self.BOUNDARY + '--\r\n')
+        self._length = sum(length for (_, _, length) in self._segments)
+        self.seek(0)
+
+    def _add(self, data):
+        self._segments.append((data, 0, len(data)))
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
+        """
+        Rewinds the body so it can be sent again; only ``seek(0)`` is supported.
+        """
+        if offset or whence:
+            raise IOError("MultipartEncoder can only be rewound to the start")
+        self._index = 0
+        self._pos = 0
+        self._sent = 0
+        for (source, start, length) in self._segments:
+            if hasattr(source, 'read'):
+                source.seek(start)
+
+    def tell(self):
+        return self._sent
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._sent
+        chunks = []
+        while size > 0 and self._index < len(self._segments):
+            source, start, length = self._segments[self._index]
+            n = min(size, length - self._pos)
+            if hasattr(source, 'read'):
+                chunk = source.read(n)
+                if not chunk:
+                    raise IOError("file shrank while it was being uploaded")
+            else:
+                chunk = source[self._pos:self._pos + n]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._pos += len(chunk)
+            if self._pos == length:
+                self._index += 1
+                self._pos = 0
+        chunk = ''.join(chunks)
+        self._sent += len(chunk)
+        if self._progress and chunk:
+            self._progress(self._sent, self._length)
+        return chunk
+
+class _TimedConnection:
+    """
+    Records how long resolving, connecting and the TLS handshake took each
+    time the connection is opened, as a ``(dns, connect, tls)`` tuple in
+    ``timings``.
+    """
+
+    timings = None
+
+    def connect(self):
+        started = time.time()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        error = None
+        for family, socktype, proto, _, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+                break
+            except socket.error as e:
+                error = e
+                sock.close()
+        else:
+            raise error or socket.error("getaddrinfo returned no addresses")
+        # httplib sends headers and body in separate writes, which Nagle's
+        # algorithm would otherwise hold back waiting on a delayed ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        if self._tunnel_host:
+            self._tunnel()
+        connected = time.time()
+        self._handshake()
+        self.timings = (resolved - started, connected - resolved, time.time() - connected)
+
+    def _handshake(self):
+        pass
+
+_connection_classes = {}
+
+def _connection_class(scheme):
+    """
+    Returns the connection class for ``scheme``, defining the classes the
+    first time, since that means importing httplib.
+    """
+    if not _connection_classes:
+        class _HTTPConnection(_TimedConnection, httplib.HTTPConnection):
+            pass
+
+        class _HTTPSConnection(_TimedConnection, httplib.HTTPSConnection):
+
+            def _handshake(self):
+                self.sock = self._context.wrap_socket(self.sock,
+                                                      server_hostname=self._tunnel_host or self.host)
+
+        _connection_classes.update(http=_HTTPConnection, https=_HTTPSConnection)
+    return _connection_classes[scheme]
+
+class RequestEvent(object):
+    """
+    What happened during one request made by a CatchSession.
+
+    ``endpoint`` is the URL template the request was made to, such as
+    "/v2/notes/{id}.json", and ``url`` the path it expanded to.  Timings are
+    in seconds: ``dns``, ``connect`` and ``tls`` are zero when a pooled
+    connection was reused, ``ttfb`` runs from the request being sent to the
+    response headers arriving, ``decode`` is the time spent decompressing and
+    decoding JSON and ``total`` the time the whole call took.  Byte counts
+    are of request and response bodies as sent, compressed or not.
+    ``cached`` is true if the response came from the session's cache, and
+    ``error`` is set if the request failed.  ``attempts`` counts the times
+    the request was tried, and ``hedged`` is true if a second copy of it was
+    sent while the first was slow to answer.  ``coalesced`` is true if the
+    response was shared with an identical request already in flight.
+    """
+
+    __slots__ = ('method', 'endpoint', 'url', 'status', 'started', 'dns', 'connect', 'tls',
+                 'ttfb', 'decode', 'total', 'bytes_sent', 'bytes_received', 'reused',
+                 'cached', 'error', 'attempts', 'hedged', 'coalesced')
+
+    def __init__(self, method, endpoint):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = endpoint
+        self.status = None
+        self.started = time.time()
+        self.dns = self.connect = self.tls = self.ttfb = self.decode = self.total = 0.0
+        self.bytes_sent = self.bytes_received = 0
+        self.reused = self.cached = self.hedged = self.coalesced = False
+        self.error = None
+        self.attempts = 0
+
+    def __repr__(self):
+        return "<RequestEvent %s %s %s %.1fms>" % (self.method, self.endpoint, self.status,
+                                                   self.total * 1000)
+
+class RequestMetrics(object):
+    """
+    Aggregates RequestEvents into counters and latency histograms per
+    endpoint.  ``attach`` it to a session to record all of its requests.
+    """
+
+    # upper bounds, in seconds, of the latency histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def attach(self, session):
+        session.add_hook('post_request', self.record)
+
+    def detach(self, session):
+        session.remove_hook('post_request', self.record)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def record(self, event):
+        with self._lock:
+            key = "%s %s" % (event.method, event.endpoint)
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = {
+                    'count': 0, 'errors': 0, 'cached': 0, 'coalesced': 0, 'retries': 0, 'hedged': 0,
+                    'statuses': {}, 'bytes_sent': 0, 'bytes_received': 0,
+                    'dns': 0.0, 'connect': 0.0, 'tls': 0.0, 'ttfb': 0.0, 'decode': 0.0,
+                    'total': 0.0, 'max': 0.0, 'histogram': [0] * len(self.BUCKETS)}
+            stats['count'] += 1
+            stats['errors'] += event.error is not None
+            stats['cached'] += event.cached
+            stats['coalesced'] += event.coalesced
+            stats['retries'] += max(event.attempts - 1, 0)
+            stats['hedged'] += event.hedged
+            stats['statuses'][event.status] = stats['statuses'].get(event.status, 0) + 1
+            stats['bytes_sent'] += event.bytes_sent
+            stats['bytes_received'] += event.bytes_received
+            for timing in ('dns', 'connect', 'tls', 'ttfb', 'decode', 'total'):
+                stats[timing] += getattr(event, timing)
+            stats['max'] = max(stats['max'], event.total)
+            for i, bound in enumerate(self.BUCKETS):
+                if event.total <= bound:
+                    stats['histogram'][i] += 1
+                    break
+
+    def percentile(self, key, p):
+        """
+        Estimates the ``p``th percentile latency of the endpoint ``key``, say
+        "GET /v2/notes.json", as the upper bound of its histogram bucket.
+        """
+        with self._lock:
+            stats = self._endpoints[key]
+            wanted = stats['count'] * p / 100.0
+            seen = 0
+            for bound, count in zip(self.BUCKETS, stats['histogram']):
+                seen += count
+                if seen >= wanted:
+                    return min(bound, stats['max'])
+            return stats['max']
+
+    def export(self):
+        """
+        Returns the collected metrics as a JSON-friendly dict, keyed by
+        method and endpoint.
+        """
+        with self._lock:
+            keys = list(self._endpoints)
+        result = {}
+        for key in keys:
+            with self._lock:
+                stats = copy.deepcopy(self._endpoints[key])
+            stats['statuses'] = dict((str(k), v) for k, v in stats['statuses'].items())
+            stats['histogram'] = dict(("%g" % bound, count) for bound, count
+                                      in zip(self.BUCKETS, stats['histogram']))
+            stats['mean'] = stats['total'] / stats['count']
+            stats['p50'] = self.percentile(key, 50)
+            stats['p99'] = self.percentile(key, 99)
+            result[key] = stats
+        return result
+
+    def dump(self, fileobj):
+        fileobj.write(json_codec().dumps(self.export(), indent=2, sort_keys=True))
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive connections to a single host.
+
+    At most ``size`` idle connections are kept; connections left idle for
+    longer than ``idle_timeout`` seconds are closed instead of being reused.
+    If ``block`` is true no more than ``size`` connections are ever open at
+    once, and callers wait for a connection to be returned to the pool.
+    """
+
+    def __init__(self, conn_class, host, port, size=10, idle_timeout=60, block=False):
+        self._conn_class = conn_class
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self._idle = collections.deque()
+        self._open = 0
+        self._cond = threading.Condition()
+
+    def get(self, wait=True, deadline=None):
+        """
+        Returns a ``(connection, reused)`` pair, where ``reused`` tells
+        whether the connection has already served a request.  A blocking
+        pool that is exhausted returns ``(None, False)`` if ``wait`` is false,
+        and raises socket.timeout if none comes free before ``deadline``.
+        """
+        with self._cond:
+            while True:
+                self._reap()
+                while self._idle:
+                    conn = self._idle.pop()[0]
+                    # an idle connection with something to read has been closed by the server
+                    if conn.sock is not None and select.select([conn.sock], [], [], 0)[0]:
+                        conn.close()
+                        self._open -= 1
+                        continue
+                    return conn, True
+                if not self.block or self._open < self.size:
+                    self._open += 1
+                    break
+                if not wait:
+                    return None, False
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out waiting for a connection")
+                self._cond.wait(remaining)
+        return self._conn_class(self.host, self.port), False
+
+    def put(self, conn):
+        """
+        Hands a connection back once its response has been read in full.
+        """
+        with self._cond:
+            if conn.sock is not None and len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """
+        Closes a connection that must not be reused.
+        """
+        conn.close()
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            while self._idle:
+                self._idle.pop()[0].close()
+                self._open -= 1
+            self._cond.notify_all()
+
+    def _reap(self):
+        # the oldest connections are on the left
+        expires = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < expires:
+            self._idle.popleft()[0].close()
+            self._open -= 1
+
+class Future(object):
+    """
+    The result of a call that is running on a session's worker threads.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for the call to finish and returns
+        its result, or raises the exception it raised.
+        """
+        if not self._done.wait(timeout):
+            raise socket.timeout("timed out waiting for result")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise socket.timeout("timed out waiting for result")
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Calls ``fn(future)`` once the call finishes, straight away if it
+        already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+class _WorkerPool(object):
+    """
+    Runs calls on up to ``size`` daemon threads, started as work arrives.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwds):
+        future = Future()
+        self._queue.put((future, fn, args, kwds))
+        with self._lock:
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def shutdown(self):
+        """
+        Lets the worker threads exit once the calls queued so far are done.
+        """
+        with self._lock:
+            for thread in self._threads:
+                self._queue.put(None)
+            self._threads = []
+
+    def _work(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            future, fn, args, kwds = work
+            try:
+                future.set_result(fn(*args, **kwds))
+            except Exception as e:
+                future.set_exception(e)
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket allowing ``rate`` calls a second on average,
+    in bursts of up to ``burst`` calls.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed.
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Allows a call and returns 0 if one may be made now, or else returns
+        how many seconds it will be until one may.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def refund(self):
+        """
+        Gives back a call allowed by try_acquire that was not made after all.
+        """
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+class RetryBudget(object):
+    """
+    Caps retries, and hedged requests, at ``ratio`` of the requests made, so
+    that a struggling server isn't sent ever more of them.  A reserve of up
+    to ``reserve`` retries builds up while requests succeed.
+    """
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self):
+        """
+        Returns whether a retry is allowed, and if so counts it.
+        """
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+class JSONStream(object):
+    """
+    Incrementally decodes a JSON object of the form ``{"key": [...], ...}``
+    from ``read``, yielding the items of the ``key`` array as each one is
+    complete.  The object's other fields are put in ``fields`` as they are
+    read.  ``release(complete)`` is called once, when the stream has been
+    read to the end or closed early.
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, read, key, decoder, release=None):
+        self.fields = {}
+        self._read = read
+        self._key = key
+        self._decoder = decoder
+        self._release = release
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._started = False
+
+    def __iter__(self):
+        if self._started:
+            raise ValueError("a JSONStream can only be iterated over once")
+        self._started = True
+        complete = False
+        try:
+            for item in self._parse():
+                yield item
+            while self._more(self.chunk_size):
+                self._buf, self._pos = '', 0
+            complete = True
+        finally:
+            self._finish(complete)
+
+    def close(self):
+        self._finish(False)
+
+    def __del__(self):
+        self._finish(False)
+
+    def _finish(self, complete):
+        release, self._release = self._release, None
+        if release is not None:
+            release(complete)
+
+    def _more(self, size):
+        chunk = '' if self._eof else self._read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more(self.chunk_size):
+                return ''
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError("expected one of %r in JSON stream, got %r" % (chars, c))
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the very end of the buffer may yet go on
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # read ever larger chunks so a big value isn't decoded over and over
+            self._more(size)
+            size *= 2
+
+    def _parse(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == self._key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+def _wbits(encoding, head):
+    if encoding == 'gzip':
+        return 16 + zlib.MAX_WBITS
+    # "deflate" ought to be zlib-wrapped, but some servers send it raw
+    if len(head) >= 2 and ord(head[0]) & 0x0f == 8 and (ord(head[0]) * 256 + ord(head[1])) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
+
+def _decompress(data, encoding):
+    """
+    Decodes a response body sent with the Content-Encoding ``encoding``.
+    """
+    if encoding not in ('gzip', 'deflate'):
+        return data
+    inflater = zlib.decompressobj(_wbits(encoding, data))
+    return inflater.decompress(data) + inflater.flush()
+
+class _Inflater(object):
+    """
+    Wraps the ``read`` function of a gzip or deflate encoded response in one
+    that returns it decoded, a chunk at a time.
+    """
+
+    def __init__(self, read, encoding):
+        self._read = read
+        self._encoding = encoding
+        self._inflater = None
+        self._eof = False
+
+    def read(self, size):
+        while not self._eof:
+            chunk = self._read(size)
+            if self._inflater is None:
+                self._inflater = zlib.decompressobj(_wbits(self._encoding, chunk))
+            if not chunk:
+                self._eof = True
+                return self._inflater.flush()
+            data = self._inflater.decompress(chunk)
+            if data:
+                return data
+        return ''
+
+def _copy(read, fileobj, progress=None, size=65536):
+    """
+    Copies a response body from ``read`` into ``fileobj`` and returns the
+    number of bytes copied, calling ``progress`` with the running count.
+    """
+    done = 0
+    while True:
+        chunk = read(size)
+        if not chunk:
+            return done
+        fileobj.write(chunk)
+        done += len(chunk)
+        if progress:
+            progress(done)
+
+BulkResult = collections.namedtuple('BulkResult', 'index item result error')
+
+class ConflictError(Exception):
+    """
+    Raised when the server refuses a change because the note was modified
+    since the ``server_modified_at`` the change was based on.  ``note`` and
+    ``changes`` are the note and the fields that were being set, when the
+    error comes from an edit.
+    """
+
+    def __init__(self, message, response=None):
+        super(ConflictError, self).__init__(message)
+        self.response = response
+        self.note = None
+        self.changes = None
+
+class NotFoundError(Exception):
+    """
+    Raised when a note, or whatever else was asked for, isn't on the server.
+    """
+
+    def __init__(self, message, response=None):
+        super(NotFoundError, self).__init__(message)
+        self.response = response
+
+# the endpoint media downloads are reported under
+MEDIA_ENDPOINT = "/v2/media/{note}/{id}"
+
+class _CacheEntry(object):
+    __slots__ = ('id', 'data', 'stored', 'etag', 'last_modified')
+
+    def __init__(self, id, data, etag=None, last_modified=None):
+        self.id = id
+        self.data = data
+        self.stored = time.time()
+        self.etag = etag
+        self.last_modified = last_modified
+
+class NoteCache(object):
+    """
+    An LRU cache of note and comment responses, for use as CatchSession.cache.
+
+    Up to ``size`` responses are kept.  Those younger than ``ttl`` seconds are
+    served without going to the server; older ones are revalidated with the
+    ETag or Last-Modified header the server sent, if any, or else fetched
+    again.  Listing notes also revalidates cached copies of them by their
+    ``server_modified_at``.  Writes to a note drop everything cached for it.
+    """
+
+    ENDPOINTS = ("/v2/notes/{id}.json", "/v2/comments/{id}.json")
+
+    def __init__(self, size=1000, ttl=300, endpoints=ENDPOINTS):
+        self.size = size
+        self.ttl = ttl
+        self.endpoints = frozenset(endpoints)
+        self.hits = self.misses = self.revalidations = self.evictions = self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._ids = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(endpoint, path, body):
+        return (endpoint, (path or {}).get('id'), tuple(sorted((body or {}).items())))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'revalidations': self.revalidations, 'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+    def lookup(self, key):
+        """
+        Returns ``(data, entry)``: a copy of the cached response if it is still
+        fresh, or else None and the stale entry, if any, to revalidate.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries[key] = entry
+            if time.time() - entry.stored < self.ttl:
+                self.hits += 1
+                return copy.deepcopy(entry.data), None
+            self.misses += 1
+            return None, entry
+
+    def revalidated(self, key, entry):
+        """
+        Marks a stale entry as confirmed by the server and returns its data.
+        """
+        with self._lock:
+            self.revalidations += 1
+            entry.stored = time.time()
+            if key not in self._entries:
+                self._add(key, entry)
+        return copy.deepcopy(entry.data)
+
+    def store(self, key, data, response):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._add(key, _CacheEntry(key[1], copy.deepcopy(data),
+                                       response.getheader('etag'),
+                                       response.getheader('last-modified')))
+
+    def observe_notes(self, token, notes):
+        """
+        Refreshes cached copies of ``notes``, as seen in a full listing.
+        """
+        with self._lock:
+            for note in notes:
+                entry = self._entries.get(self.key("/v2/notes/{id}.json", note, {'access_token': token}))
+                if entry is None:
+                    continue
+                if entry.data['notes'][0].get('server_modified_at') != note.get('server_modified_at'):
+                    entry.data = {'notes': [copy.deepcopy(note)]}
+                    entry.etag = entry.last_modified = None
+                else:
+                    self.revalidations += 1
+                entry.stored = time.time()
+
+    def invalidate(self, id):
+        """
+        Drops every response cached for the note ``id``.
+        """
+        with self._lock:
+            for key in self._ids.pop(id, ()):
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        self._ids[entry.id].add(key)
+        while len(self._entries) > self.size:
+            key, entry = self._entries.popitem(last=False)
+            self._ids[entry.id].discard(key)
+            if not self._ids[entry.id]:
+                del self._ids[entry.id]
+            self.evictions += 1
+
+class MediaCache(object):
+    """
+    A content-addressed store of downloaded media, for use as
+    CatchSession.media_cache.
+
+    Files are kept under the directory ``path`` by the SHA-256 of their
+    content, so identical content is stored once however many media it
+    belongs to, and each media's source URL maps to the content it was
+    found to have, so it is never downloaded twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for name in ('objects', 'refs', 'tmp'):
+            try:
+                os.makedirs(os.path.join(path, name))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _ref(self, key):
+        return os.path.join(self.path, 'refs', hashlib.sha256(key).hexdigest())
+
+    def _object(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def get(self, key):
+        """
+        Returns the path of the content stored for ``key``, or None.
+        """
+        try:
+            with open(self._ref(key)) as f:
+                path = self._object(f.read().strip())
+        except IOError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def add(self, key, filename):
+        """
+        Stores a copy of the file ``filename`` as the content of ``key`` and
+        returns the path of the stored copy.
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        path = self._object(digest)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            temp = self.tempfile()
+            shutil.copyfile(filename, temp)
+            os.rename(temp, path)
+        temp = self.tempfile()
+        with open(temp, 'w') as f:
+            f.write(digest)
+        os.rename(temp, self._ref(key))
+        return path
+
+    def tempfile(self):
+        """
+        Returns the path of a new, empty file on the same filesystem as the
+        cache.
+        """
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+        os.close(fd)
+        return path
+
+class EditBuffer(object):
+    """
+    Holds back note edits and merges those made through the same Note, so
+    that each note is sent once with all of its changes; see
+    CatchSession.write_behind.  Where the same field is set more than once,
+    the last value wins.  As with Note.edit, the server checks the merged
+    edit against the Note's ``server_modified_at``, as it stands when the
+    edit is sent, so edits made through a stale copy of a note raise a
+    ConflictError just as they would unbuffered.  Edits made through
+    different copies of one note are sent one after the other, in the order
+    they were made.  Notes are only updated once their edits are sent.
+
+    The edits are sent, ``concurrency`` notes at a time, by ``flush``, once
+    ``max_notes`` notes have edits waiting, and ``delay`` seconds after the
+    first edit that is waiting, unless ``delay`` is None.
+    """
+
+    def __init__(self, delay=1.0, max_notes=100, concurrency=8):
+        self.delay = delay
+        self.max_notes = max_notes
+        self.concurrency = concurrency
+        self.flushes = 0
+        self._pending = collections.OrderedDict()
+        self._errors = []
+        self._lock = threading.Lock()
+        # one flush at a time, so that each starts from the notes the last left
+        self._sending = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def edit(self, note, changes):
+        with self._lock:
+            # by Note rather than id, so each copy's edit is checked against its own version
+            if id(note) in self._pending:
+                self._pending[id(note)][1].update(changes)
+            else:
+                self._pending[id(note)] = (note, dict(changes))
+            full = len(self._pending) >= self.max_notes
+            if not full and self._timer is None and self.delay is not None:
+                self._timer = threading.Timer(self.delay, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends every edit that is waiting, and raises the first error met by
+        this or by any earlier flush on the timer, such as a ConflictError.
+        """
+        self._send()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def discard(self):
+        """
+        Forgets the edits that are waiting without sending them.
+        """
+        with self._lock:
+            self._pending.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _flush_later(self):
+        # errors are kept to be raised to the caller by the next flush
+        self._send()
+
+    def _send(self):
+        with self._sending:
+            with self._lock:
+                pending, self._pending = self._pending.values(), collections.OrderedDict()
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not pending:
+                return
+            self.flushes += 1
+            by_id = collections.OrderedDict()
+            for note, changes in pending:
+                by_id.setdefault(note['id'], []).append((note, changes))
+            workers = _WorkerPool(min(self.concurrency, len(by_id)))
+            futures = [workers.submit(self._send_edits, edits) for edits in by_id.values()]
+            workers.shutdown()
+            for future in futures:
+                errors = future.result()
+                with self._lock:
+                    self._errors.extend(errors)
+
+    def _send_edits(self, edits):
+        errors = []
+        for note, changes in edits:
+            try:
+                note._edit(changes)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+# the endpoints whose concurrent, identical GETs share one request by default
+COALESCE_ENDPOINTS = ("/v2/notes/{id}.json", "/v2/comments/{id}.json", "/v2/notes.json", "/v1/tags.json")
+
 class CatchSession(object):
     """
     """
 
-    def __init__(self, host="https://api.catch.com", timeout=10):
+    # statuses on which GET requests are retried
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, host="https://api.catch.com", timeout=10,
+                 pool_size=10, pool_block=False, pool_idle_timeout=60, cache=None,
+                 retries=2, retry_backoff=0.05, retry_budget=None, hedge=False,
+                 hedge_percentile=95, compression=True, compress_requests=False,
+                 compress_threshold=1024, media_cache=None, coalesce=COALESCE_ENDPOINTS, codec=None):
+        self.codec = codec if codec is not None and not isinstance(codec, basestring) else json_codec(codec)
+        self.cache = cache
+        self.coalesce = frozenset(coalesce)
+        self.coalesced = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.media_cache = media_cache
+        self.compression = compression
+        self.compress_requests = compress_requests
+        self.compress_threshold = compress_threshold
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_budget = retry_budget or RetryBudget()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self._latencies = {}
+        self._local = threading.local()
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._workers = None
+        self._listeners = []
+        self._hooks = {'pre_request': [], 'post_request': []}
+        self._pool_size = pool_size
+        self._pool_block = pool_block
+        self._pool_idle_timeout = pool_idle_timeout
         self.host = host
         self._timeout = timeout
 
     @property
     def host(self):
-        return "%s://%s" % ({80: "http", 443: "https"}[self._api_port], self._api_host)
+        default = {"http": 80, "https": 443}[self._api_scheme]
+        if self._api_port == default:
+            return "%s://%s" % (self._api_scheme, self._api_host)
+        return "%s://%s:%d" % (self._api_scheme, self._api_host, self._api_port)
 
     @host.setter
     def host(self, host):
         host = urlparse.urlsplit(host)
-        self._api_host = host.netloc
-        self._api_port = {"http": 80, "https": 443}[host.scheme]
-        self._conn_class = {"http": httplib.HTTPConnection,
-                            "https": httplib.HTTPSConnection}[host.scheme]
+        self._api_scheme = host.scheme
+        self._api_host = host.hostname
+        self._api_port = host.port or {"http": 80, "https": 443}[host.scheme]
+
+    @property
+    def _pool(self):
+        return self._pool_for(self._api_scheme, self._api_host, self._api_port)
+
+    def _pool_for(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(_connection_class(scheme), host, port,
+                                                  size=self._pool_size,
+                                                  idle_timeout=self._pool_idle_timeout,
+                                                  block=self._pool_block)
+            return self._pools[key]
+
+    def _submit(self, fn, *args, **kwds):
+        """
+        Runs ``fn`` on the session's worker threads, of which there are as
+        many as the connection pool holds, and returns a Future.
+        """
+        with self._pools_lock:
+            if self._workers is None:
+                self._workers = _WorkerPool(self._pool_size)
+        return self._workers.submit(fn, *args, **kwds)
+
+    def close(self):
+        """
+        Closes every idle connection held by the session.
+        """
+        with self._pools_lock:
+            pools = self._pools.values()
+        for pool in pools:
+            pool.clear()
 
-    def _request(self, method, url, body=None, headers=None):
+    def add_listener(self, listener):
+        """
+        Registers ``listener(event, notes)`` to be told about notes as they pass
+        through the session.  ``event`` is "notes" when notes are fetched in
+        full, posted or edited, "comments" when their comments are fetched
+        and "deleted" when they are deleted.  Listeners may be called from
+        worker threads.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, notes):
+        if event != 'deleted':
+            # listeners reading a summary would load it, and could come back here while doing so
+            notes = [n for n in notes if getattr(n, '_hydrator', None) is None]
+            if not notes:
+                return
+        for listener in self._listeners:
+            listener(event, notes)
+
+    def _invalidate(self, id):
+        if self.cache is not None:
+            self.cache.invalidate(id)
+        with self._flights_lock:
+            # reads of the note, or of listings that may hold it, that were
+            # sent before the write mustn't be shared with reads made after it
+            for key in [k for k in self._flights if dict(k[1]).get('id', id) == id]:
+                del self._flights[key]
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """
+        Gives the requests this thread makes within the block, retries and
+        all, ``seconds`` from now to complete, after which they fail with
+        socket.timeout.  Without one each request gets the session's timeout.
+        """
+        outer = getattr(self._local, 'deadline', None)
+        deadline = time.time() + seconds
+        self._local.deadline = deadline if outer is None else min(outer, deadline)
+        try:
+            yield
+        finally:
+            self._local.deadline = outer
+
+    @contextlib.contextmanager
+    def write_behind(self, delay=1.0, max_notes=100, concurrency=8):
+        """
+        Holds back the edits made to notes within the block, in an
+        EditBuffer that merges those made to the same note into one request
+        and sends them ``delay`` seconds later, once ``max_notes`` notes
+        have been edited, or when the block ends, whichever comes first.
+        Conflicts are raised from the edit that filled the buffer or from
+        the end of the block.  Like ``deadline``, the buffer applies only to
+        the edits this thread makes.
+
+            with session.write_behind():
+                note.edit(text="new text")
+                note.edit(tags="todo")  # sent with the text, in one request
+        """
+        outer = self.edit_buffer
+        buffer = self._local.edit_buffer = EditBuffer(delay, max_notes, concurrency)
+        try:
+            yield buffer
+        except:
+            # don't send edits the block didn't finish making
+            buffer.discard()
+            raise
+        finally:
+            self._local.edit_buffer = outer
+        buffer.flush()
+
+    @property
+    def edit_buffer(self):
+        """
+        The EditBuffer of this thread's innermost ``write_behind`` block, or
+        None outside of one.
+        """
+        return getattr(self._local, 'edit_buffer', None)
+
+    def _deadline(self):
+        deadline = time.time() + self._timeout
+        if getattr(self._local, 'deadline', None) is not None:
+            deadline = min(deadline, self._local.deadline)
+        return deadline
+
+    def _hedge_delay(self, endpoint):
+        """
+        How long to wait for a response from ``endpoint`` before sending a
+        second copy of the request: the ``hedge_percentile``th percentile of
+        its recent times to first byte, or None until there are enough.
+        """
+        latencies = self._latencies.get(endpoint)
+        if latencies is None or len(latencies) < 20:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * self.hedge_percentile // 100)]
+
+    def add_hook(self, kind, hook):
+        """
+        Registers ``hook(event)`` to be called with a RequestEvent before
+        ("pre_request") or after ("post_request") every request the session
+        makes.  Hooks may be called from worker threads.
+        """
+        self._hooks[kind].append(hook)
+
+    def remove_hook(self, kind, hook):
+        self._hooks[kind].remove(hook)
+
+    def _request(self, method, url, body=None, headers=None, path=None, stream=None):
+        """
+        Makes a request and returns the decoded JSON response.  ``url`` may
+        be a template whose fields are filled in from ``path``.  If ``stream``
+        names a top-level array in the response, a JSONStream that decodes
+        the items of that array one by one is returned instead.
+
+        A GET to one of the ``coalesce`` endpoints that is identical to one
+        already in flight waits for and shares that request's response, and
+        is counted in ``coalesced``.  Reads sent before a write to a note
+        are not shared with reads made after it.
+        """
+        event = RequestEvent(method, url.split('?')[0])
+        flight = own = key = None
+        if not stream and method == "GET" and event.endpoint in self.coalesce:
+            key = (url, tuple(sorted((path or {}).items())), tuple(sorted((body or {}).items())))
+            with self._flights_lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    # the future for the response and the number of requests sharing it
+                    own = self._flights[key] = [Future(), 0]
+                else:
+                    flight[1] += 1
+                    self.coalesced += 1
+        if flight is not None:
+            # an identical request is in flight; share its response
+            event.coalesced = True
+            for hook in self._hooks['pre_request']:
+                hook(event)
+            try:
+                result = copy.deepcopy(flight[0].result(max(0, self._deadline() - time.time())))
+            except Exception as e:
+                event.error = e
+                raise
+            finally:
+                self._finish(event)
+            return result
+        try:
+            # a leader's hooks run once its flight can be joined
+            for hook in self._hooks['pre_request']:
+                hook(event)
+            result = self._perform(event, method, url, body, headers, path, stream)
+        except BaseException as e:
+            # settle the flight first, so that a failing hook can't strand its followers
+            if own is not None:
+                self._land(key, own, error=e)
+            if isinstance(e, Exception):
+                event.error = e
+                self._finish(event)
+            raise
+        if own is not None:
+            self._land(key, own, result=result)
+            if own[1]:
+                # leave what the followers copy from as it was
+                result = copy.deepcopy(result)
+        if not stream:
+            self._finish(event)
+        return result
+
+    def _land(self, key, flight, result=None, error=None):
+        with self._flights_lock:
+            # it may have been evicted, and a newer flight started in its place
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if error is None:
+            flight[0].set_result(result)
+        elif isinstance(error, Exception):
+            flight[0].set_exception(error)
+        else:
+            flight[0].set_exception(IOError("the shared request was interrupted"))
+
+    def _finish(self, event):
+        event.total = time.time() - event.started
+        if self.hedge and event.error is None and event.status == 200 and not event.hedged:
+            latencies = self._latencies.get(event.endpoint)
+            if latencies is None:
+                latencies = self._latencies.setdefault(event.endpoint, collections.deque(maxlen=200))
+            latencies.append(event.ttfb)
+        for hook in self._hooks['post_request']:
+            hook(event)
+
+    def _perform(self, event, method, url, body, headers, path, stream):
+        endpoint = url
+        if path:
+            url = url.format(**path)
+        event.url = url
         headers = headers or {}
         headers.setdefault('User-Agent', self._user_agent)
+
+        cache = self.cache
+        if cache is not None and (stream or method != "GET" or endpoint not in cache.endpoints):
+            cache = None
+        if cache is not None:
+            key = cache.key(endpoint, path, body)
+            data, entry = cache.lookup(key)
+            if data is not None:
+                event.cached = True
+                return data
+            if entry is not None and entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry is not None and entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
         if isinstance(body, dict):
             if method in ("GET", "DELETE"):
                 url = "%s%s%s" % (url, "&" if "?" in url else "?", urllib.urlencode(body, doseq=True))
@@ -241,15 +2156,394 @@ class CatchSession(object):
             else:
                 headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
                 body = urllib.urlencode(body, doseq=True)
+        if self.compression:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if self.compress_requests and isinstance(body, str) and len(body) >= self.compress_threshold:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(body) + compressor.flush()
+            if len(compressed) < len(body):
+                body = compressed
+                headers['Content-Encoding'] = 'gzip'
         headers.setdefault("Content-Length", len(body or ""))
+        deadline = self._deadline()
 
-        conn = self._conn_class(self._api_host, self._api_port)
-        conn.request(method, url, body=body, headers=headers)
-        response = conn.getresponse()
-        data = json.loads(response.read())
-        conn.close()
+        if stream:
+            response, release = self._send(event, method, url, body, headers, deadline, stream=True)
+
+            def read(size):
+                if time.time() >= deadline:
+                    raise socket.timeout("deadline exceeded")
+                chunk = response.read(size)
+                event.bytes_received += len(chunk)
+                return chunk
+
+            encoding = (response.getheader('content-encoding') or '').strip().lower()
+            if encoding in ('gzip', 'deflate'):
+                read = _Inflater(read, encoding).read
+
+            def finish(complete):
+                release(complete)
+                self._finish(event)
+
+            return JSONStream(read, stream, self.codec.decoder(), finish)
+
+        response, payload = self._exchange(event, method, url, body, headers, deadline)
+        if cache is not None and entry is not None and response.status == 304:
+            event.cached = True
+            return cache.revalidated(key, entry)
+        started = time.time()
+        encoding = (response.getheader('content-encoding') or '').strip().lower()
+        data = self.codec.loads(_decompress(payload, encoding))
+        event.decode = time.time() - started
+        if response.status == 409:
+            raise ConflictError(data.get('message', "conflict") if isinstance(data, dict) else "conflict",
+                                data)
+        if response.status == 404 and method == "GET":
+            raise NotFoundError(data.get('message', "not found") if isinstance(data, dict) else "not found",
+                                data)
+        if cache is not None and response.status == 200:
+            cache.store(key, data, response)
         return data
 
+    def _exchange(self, event, method, url, body, headers, deadline):
+        """
+        Sends a request and returns the response and its body.  GETs that
+        fail to connect, time out or get a 5xx are retried after a jittered,
+        exponentially growing pause, for as long as ``retries``, the deadline
+        and the retry budget allow, and are hedged if the session says so.
+        """
+        idempotent = method == "GET"
+        self.retry_budget.deposit()
+        while True:
+            hedge_after = None
+            if idempotent and self.hedge:
+                hedge_after = self._hedge_delay(event.endpoint)
+            error = None
+            try:
+                response, payload = self._send(event, method, url, body, headers, deadline,
+                                               hedge_after=hedge_after)
+                if not idempotent or response.status not in self.RETRY_STATUSES:
+                    return response, payload
+            except (socket.error, httplib.HTTPException) as e:
+                if not idempotent:
+                    raise
+                error = e
+            pause = random.uniform(0, min(2.0, self.retry_backoff * 2 ** (event.attempts - 1)))
+            if (event.attempts > self.retries or time.time() + pause >= deadline or
+                    not self.retry_budget.withdraw()):
+                if error is not None:
+                    raise error
+                return response, payload
+            time.sleep(pause)
+
+    def _open(self, url, endpoint, headers=None):
+        """
+        Starts a GET of ``url``, which may be on another host than the API,
+        for a body that isn't JSON.  Returns the response, a function that
+        reads its body and one to call with whether it was read in full.
+        """
+        split = urlparse.urlsplit(url)
+        if split.hostname:
+            scheme, host = split.scheme, split.hostname
+            port = split.port or {"http": 80, "https": 443}[scheme]
+        else:
+            scheme, host, port = self._api_scheme, self._api_host, self._api_port
+        url = "%s?%s" % (split.path, split.query) if split.query else split.path
+        event = RequestEvent("GET", endpoint)
+        event.url = url
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', self._user_agent)
+        for hook in self._hooks['pre_request']:
+            hook(event)
+        try:
+            response, release = self._send(event, "GET", url, None, headers, self._deadline(),
+                                           stream=True, pool=self._pool_for(scheme, host, port))
+        except Exception as e:
+            event.error = e
+            self._finish(event)
+            raise
+
+        def read(size):
+            chunk = response.read(size)
+            event.bytes_received += len(chunk)
+            return chunk
+
+        def finish(complete):
+            release(complete)
+            self._finish(event)
+
+        return response, read, finish
+
+    def _download(self, url, key, dest, parallel, chunk_size, progress):
+        """
+        Downloads ``url`` to ``dest`` for Media.download, by way of the media
+        cache if there is one, in which ``key`` names the content.
+        """
+        cache = self.media_cache
+        stored = cache.get(key) if cache is not None else None
+        if stored is None and cache is not None and hasattr(dest, 'write'):
+            # download to the cache first, then copy from there
+            path = cache.tempfile()
+            try:
+                self._download_file(url, key, path, parallel, chunk_size, progress)
+                stored = cache.add(key, path)
+            finally:
+                os.remove(path)
+        elif stored is None:
+            if hasattr(dest, 'write'):
+                self._download_stream(url, dest, progress)
+            else:
+                self._download_file(url, key, dest, parallel, chunk_size, progress)
+                if cache is not None:
+                    cache.add(key, dest)
+            return dest
+        if hasattr(dest, 'write'):
+            with open(stored, 'rb') as f:
+                shutil.copyfileobj(f, dest)
+        else:
+            shutil.copyfile(stored, dest)
+        return dest
+
+    def _download_stream(self, url, fileobj, progress):
+        response, read, finish = self._open(url, MEDIA_ENDPOINT)
+        complete = False
+        try:
+            if response.status != 200:
+                raise IOError("HTTP %d downloading %s" % (response.status, url.split('?')[0]))
+            total = int(response.getheader('content-length') or 0)
+            _copy(read, fileobj, progress and (lambda done: progress(done, total)))
+            complete = True
+        finally:
+            finish(complete)
+
+    def _download_file(self, url, key, path, parallel, chunk_size, progress):
+        part = path + ".part"
+        state_path = part + ".json"
+        state = None
+        if os.path.exists(part) and os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = self.codec.loads(f.read())
+            except ValueError:
+                pass
+            if not state or state.get('key') != key or state.get('chunk_size') != chunk_size:
+                state = None
+
+        def save():
+            with open(state_path + ".tmp", 'w') as f:
+                f.write(self.codec.dumps(state))
+            os.rename(state_path + ".tmp", state_path)
+
+        if state is None:
+            # the first range tells how big the whole file is
+            response, read, finish = self._open(url, MEDIA_ENDPOINT,
+                                                {'Range': "bytes=0-%d" % (chunk_size - 1)})
+            complete = False
+            try:
+                if response.status == 206:
+                    total = int(response.getheader('content-range').rsplit('/', 1)[1])
+                    state = {'key': key, 'size': total, 'chunk_size': chunk_size, 'done': [0]}
+                elif response.status == 200:
+                    # the server ignores ranges; take the whole file in one go
+                    total = response.getheader('content-length')
+                elif response.status == 416:
+                    total = 0
+                else:
+                    raise IOError("HTTP %d downloading %s" % (response.status, url.split('?')[0]))
+                with open(part, 'wb') as f:
+                    if state is not None:
+                        f.truncate(total)
+                    copied = _copy(read, f, progress and (lambda done: progress(done, int(total or 0))))
+                complete = True
+            finally:
+                finish(complete)
+            total = int(copied if total is None else total)
+            if state is not None:
+                save()
+
+        if state is not None:
+            total = state['size']
+            done = set(state['done'])
+            pending = [i for i in range((total + chunk_size - 1) // chunk_size) if i not in done]
+            lock = threading.Lock()
+            failed = []
+            written = [sum(min(chunk_size, total - i * chunk_size) for i in done)]
+
+            def advance(count):
+                with lock:
+                    written[0] += count
+                    if progress:
+                        progress(written[0], total)
+
+            def fetch(i):
+                if failed:
+                    return
+                start = i * chunk_size
+                end = min(total, start + chunk_size) - 1
+                for attempt in range(self.retries + 1):
+                    got = [0]
+
+                    def count(done):
+                        advance(done - got[0])
+                        got[0] = done
+
+                    response, read, finish = self._open(url, MEDIA_ENDPOINT,
+                                                        {'Range': "bytes=%d-%d" % (start, end)})
+                    complete = False
+                    try:
+                        if response.status != 206 or not (response.getheader('content-range') or
+                                                          '').startswith("bytes %d-" % start):
+                            raise IOError("HTTP %d downloading range %d-%d of %s" % (
+                                response.status, start, end, url.split('?')[0]))
+                        with open(part, 'r+b') as f:
+                            f.seek(start)
+                            _copy(read, f, count)
+                        complete = True
+                    except (socket.error, httplib.HTTPException):
+                        advance(-got[0])
+                        if attempt == self.retries:
+                            raise
+                        continue
+                    finally:
+                        finish(complete)
+                    with lock:
+                        state['done'].append(i)
+                        save()
+                    return
+
+            if pending:
+                workers = _WorkerPool(min(parallel, len(pending)))
+                futures = [workers.submit(fetch, i) for i in pending]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    # skip the ranges not yet started, and wait for the rest
+                    failed.append(True)
+                    for future in futures:
+                        future.exception()
+                    raise
+                finally:
+                    workers.shutdown()
+
+        if os.path.getsize(part) != total:
+            raise IOError("downloaded %d of %d bytes of %s" % (os.path.getsize(part), total,
+                                                               url.split('?')[0]))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(part, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def _send(self, event, method, url, body, headers, deadline, stream=False, hedge_after=None,
+              pool=None):
+        """
+        Returns the response and its body, or, when streaming, the response
+        and a function to call with whether the body was read in full once
+        it is done with.  Timings and sizes are recorded on ``event``.
+
+        If no response has begun to arrive ``hedge_after`` seconds after the
+        request was sent, a second copy is sent on another connection and
+        whichever of the two answers first is used.
+        """
+        pool = pool or self._pool
+        event.attempts += 1
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise socket.timeout("deadline exceeded")
+            attempts = []
+            responded = False
+            try:
+                attempts.append(self._dispatch(pool, method, url, body, headers, timeout))
+                if hedge_after is not None and hedge_after < timeout:
+                    if (not select.select([attempts[0][0].sock], [], [], hedge_after)[0] and
+                            time.time() < deadline and self.retry_budget.withdraw()):
+                        # never wait on the pool for a hedge, or threads that
+                        # each hold a connection could wait on one another
+                        try:
+                            hedge = self._dispatch(pool, method, url, body, headers,
+                                                   deadline - time.time(), wait=False)
+                        except (socket.error, httplib.HTTPException):
+                            hedge = None
+                        if hedge is not None:
+                            event.hedged = True
+                            attempts.append(hedge)
+                            ready = select.select([hedge[0].sock, attempts[0][0].sock], [], [],
+                                                  max(deadline - time.time(), 0))[0]
+                            if ready and ready[0] is hedge[0].sock:
+                                attempts.reverse()
+                conn, reused, sent = attempts[0]
+                response = conn.getresponse()
+                responded = True
+                event.ttfb = time.time() - sent
+                payload = None if stream else response.read()
+            except (socket.error, httplib.HTTPException) as e:
+                for conn, _, _ in attempts:
+                    pool.discard(conn)
+                # a kept-alive connection may have been dropped by the server
+                # while it sat in the pool; retry a GET on another one, as long
+                # as nothing of a response came back.  Anything else may have
+                # been acted on already, and _dispatch has retried what failed
+                # before the request was sent.
+                if (method == "GET" and attempts and attempts[0][1] and not responded and
+                        not isinstance(e, socket.timeout) and
+                        (not isinstance(e, httplib.BadStatusLine) or e.line in ("", "''"))):
+                    continue
+                raise
+            # the slower copy of a hedged request is abandoned
+            for other, _, _ in attempts[1:]:
+                pool.discard(other)
+            if time.time() >= deadline:
+                # socket timeouts only bound each read, not a response that trickles in
+                if stream:
+                    pool.discard(conn)
+                else:
+                    pool.put(conn)
+                raise socket.timeout("deadline exceeded")
+            event.reused = reused
+            event.status = response.status
+            event.bytes_sent = len(body or "")
+            if conn.timings:
+                event.dns, event.connect, event.tls = conn.timings
+                conn.timings = None
+            if stream:
+                return response, lambda complete: (pool.put if complete else pool.discard)(conn)
+            event.bytes_received = len(payload)
+            pool.put(conn)
+            return response, payload
+
+    def _dispatch(self, pool, method, url, body, headers, timeout, wait=True):
+        """
+        Sends a request on a pooled connection whose socket operations time
+        out after ``timeout`` seconds.  Returns the connection, whether it was
+        reused and when the request was sent, or None if ``wait`` is false and
+        no connection is to be had.
+        """
+        deadline = time.time() + timeout
+        while True:
+            conn, reused = pool.get(wait, deadline)
+            if conn is None:
+                return None
+            # what waiting for the connection left of the time
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                pool.put(conn)
+                raise socket.timeout("deadline exceeded")
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+            except (socket.error, httplib.HTTPException):
+                pool.discard(conn)
+                if reused:
+                    continue
+                raise
+            return conn, reused, time.time()
+
     def login(self, username, password):
         data = self._request("POST", "/v2/user", headers={
             'Authorization': "Basic %s" % base64.standard_b64encode(":".join((username, password)))
@@ -259,3 +2553,59 @@ class CatchSession(object):
     @property
     def _user_agent(self):
         return ' '.join(("python", "catch.api-%s" % __version__))
+
+class AsyncCatchSession(CatchSession):
+    """
+    A CatchSession whose operations return a Future instead of blocking.
+
+    Calls run on a shared pool of ``concurrency`` worker threads which draw
+    from a connection pool of the same size, so no more than ``concurrency``
+    requests are ever in flight at once.  The User, Note, Media and Comment
+    objects that the futures resolve to are bound to this session and can
+    still be used synchronously.
+    """
+
+    def __init__(self, host="https://api.catch.com", timeout=10, concurrency=32, **kwds):
+        kwds.setdefault('pool_size', concurrency)
+        kwds.setdefault('pool_block', True)
+        super(AsyncCatchSession, self).__init__(host, timeout, **kwds)
+
+    def login(self, username, password):
+        return self._submit(super(AsyncCatchSession, self).login, username, password)
+
+    def tags(self, user):
+        return self._submit(lambda: user.tags)
+
+    def get_note(self, user, id):
+        return self._submit(user.get_note, id)
+
+    def get_notes(self, user, offset=0, limit=20, full=True, with_comments=False):
+        return self._submit(user.get_notes, offset, limit, full, with_comments)
+
+    def post_note(self, user, text, **kwds):
+        return self._submit(user.post_note, text, **kwds)
+
+    def edit(self, note, **kwds):
+        return self._submit(note.edit, **kwds)
+
+    def add_media(self, note, filename, **opts):
+        return self._submit(note.add_media, filename, **opts)
+
+    def add_comment(self, note, **opts):
+        return self._submit(note.add_comment, **opts)
+
+    def comments(self, note):
+        return self._submit(lambda: note.comments)
+
+    def delete(self, obj):
+        """
+        Deletes a Note, Media or Comment.
+        """
+        return self._submit(obj.delete)
+
+    def notes(self, user, page_size=100, prefetch=4, with_comments=False):
+        """
+        Iterates over all of ``user``'s notes, fetching the following pages in
+        the background while the current one is being consumed.
+        """
+        return user.iter_notes(page_size, prefetch, with_comments=with_comments)
@@ -0,0 +1,198 @@
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''Exports a Catch account to newline-delimited JSON, optionally archived'''
+
+import errno, os, shutil, tarfile, threading, zipfile, Queue
+
+class Exporter(object):
+    """
+    Writes all of a user's notes to ``path``, one JSON object per line, with
+    each note's comments under "comments" if ``comments`` is true.  With
+    ``media_files=True`` the media themselves are downloaded too, and each
+    media reference gains the "path" of its file.  ``format`` is "ndjson",
+    which puts any media files in the directory ``path + ".media"``, or
+    "tar" or "zip" for a single archive holding notes.ndjson and the media.
+
+    Notes are fetched a page at a time on one thread and written out on the
+    calling one, with at most ``queue_size`` pages waiting in between, so
+    memory use doesn't grow with the account.  The export is staged in the
+    directory ``path + ".parts"``, together with a checkpoint recording the
+    listing offset reached and how much of the output was written by then.
+    Running an interrupted export again carries on from its last checkpoint,
+    unless notes have since been added or deleted, which shifts the listing
+    and makes it start over.
+    """
+
+    def __init__(self, user, path, format="ndjson", comments=True, media_files=False,
+                 page_size=100, queue_size=4):
+        if format not in ("ndjson", "tar", "zip"):
+            raise ValueError("unknown export format %r" % format)
+        self.user = user
+        self.codec = user._session.codec
+        self.path = path
+        self.format = format
+        self.comments = comments
+        self.media_files = media_files
+        self.page_size = page_size
+        self.queue_size = queue_size
+        self.staging = path + ".parts"
+
+    def run(self, progress=None):
+        """
+        Runs the export, or what is left of it, and returns a dict of the
+        notes and media files exported.  ``progress``, if given, is called as
+        ``progress(notes_written, note_count)`` after every page.
+        """
+        try:
+            os.makedirs(os.path.join(self.staging, "media"))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        checkpoint = self._load_checkpoint()
+        notes, count = self.user.get_notes(0, 1, full=False)
+        if checkpoint and checkpoint['count'] != count:
+            checkpoint = None
+        if checkpoint is None:
+            checkpoint = {'offset': 0, 'count': count, 'bytes': 0, 'notes': 0, 'media': 0}
+
+        pages = Queue.Queue(self.queue_size)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch, args=(checkpoint['offset'], count, pages, stop))
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            path = os.path.join(self.staging, "notes.ndjson")
+            with open(path, "r+b" if os.path.exists(path) else "wb") as out:
+                # drop whatever was written after the last checkpoint
+                out.seek(checkpoint['bytes'])
+                out.truncate()
+                while True:
+                    page = pages.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    offset, notes, media = page
+                    for note in notes:
+                        out.write(self.codec.dumps(self._record(note)))
+                        out.write("\n")
+                    out.flush()
+                    os.fsync(out.fileno())
+                    checkpoint.update(offset=offset + self.page_size, bytes=out.tell(),
+                                      notes=checkpoint['notes'] + len(notes),
+                                      media=checkpoint['media'] + media)
+                    self._save_checkpoint(checkpoint)
+                    if progress:
+                        progress(checkpoint['notes'], count)
+        finally:
+            stop.set()
+            # unblock the fetcher if it is waiting for room in the queue
+            while fetcher.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+        self._finish()
+        return {'notes': checkpoint['notes'], 'media': checkpoint['media']}
+
+    def _fetch(self, offset, count, pages, stop):
+        try:
+            while offset < count and not stop.is_set():
+                notes, count = self.user.get_notes(offset, self.page_size, with_comments=self.comments)
+                media = 0
+                if self.media_files:
+                    media = self._download(notes)
+                pages.put((offset, notes, media))
+                offset += self.page_size
+            pages.put(None)
+        except Exception as e:
+            pages.put(e)
+
+    def _download(self, notes):
+        downloaded = 0
+        for note in notes:
+            for media in note['media']:
+                path = os.path.join(self.staging, self._media_path(note, media))
+                if os.path.exists(path):
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                media.download(path)
+                downloaded += 1
+        return downloaded
+
+    def _media_path(self, note, media):
+        return "media/%s/%s" % (note['id'], media['id'])
+
+    def _record(self, note):
+        record = dict(note)
+        record['media'] = [dict(m) for m in note['media']]
+        if self.media_files:
+            for media in record['media']:
+                media['path'] = self._media_path(note, media)
+        if self.comments:
+            record['comments'] = [dict(c) for c in note.comments]
+        return record
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.staging, "checkpoint.json")) as f:
+                return self.codec.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _save_checkpoint(self, checkpoint):
+        path = os.path.join(self.staging, "checkpoint.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(self.codec.dumps(checkpoint))
+        os.rename(path + ".tmp", path)
+
+    def _finish(self):
+        notes = os.path.join(self.staging, "notes.ndjson")
+        media = os.path.join(self.staging, "media")
+        if self.format == "ndjson":
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(notes, self.path)
+            if self.media_files:
+                if os.path.exists(self.path + ".media"):
+                    shutil.rmtree(self.path + ".media")
+                os.rename(media, self.path + ".media")
+        elif self.format == "tar":
+            archive = tarfile.open(self.path + ".tmp", "w")
+            try:
+                archive.add(notes, "notes.ndjson")
+                if self.media_files:
+                    archive.add(media, "media")
+            finally:
+                archive.close()
+            os.rename(self.path + ".tmp", self.path)
+        else:
+            archive = zipfile.ZipFile(self.path + ".tmp", "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+            try:
+                archive.write(notes, "notes.ndjson")
+                if self.media_files:
+                    for directory, _, files in os.walk(media):
+                        for name in files:
+                            path = os.path.join(directory, name)
+                            # media are mostly compressed already
+                            archive.write(path, os.path.relpath(path, self.staging), zipfile.ZIP_STORED)
+            finally:
+                archive.close()
+            os.rename(self.path + ".tmp", self.path)
+        shutil.rmtree(self.staging)
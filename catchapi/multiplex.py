@@ -0,0 +1,175 @@
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''Schedules the work of many Catch accounts over one session'''
+
+import collections, threading
+
+from catchapi import Future, RateLimiter
+
+# priority classes, most urgent first
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+class _Account(object):
+
+    def __init__(self, rate=None, burst=1, concurrency=None):
+        self.limiter = RateLimiter(rate, burst) if rate else None
+        self.concurrency = concurrency
+        self.running = 0
+        self.queues = collections.defaultdict(collections.deque)
+
+class Multiplexer(object):
+    """
+    Runs calls on behalf of many users over one CatchSession, and so over
+    its one connection pool, on ``concurrency`` worker threads.
+
+    Each user's calls wait in a queue of their own, and the workers take
+    from the queues in turn, so a user with a long backlog only ever gets
+    its share of the workers.  Calls of a more urgent priority class, say
+    INTERACTIVE reads, are always taken before those of a less urgent one,
+    such as a BACKGROUND sync.  Calls can be limited to ``rate`` a second
+    overall and ``user_rate`` a second per user, and each user to
+    ``user_concurrency`` calls at once; limits for a particular user can be
+    set with ``set_limits``.  A user that is over its limits is passed over
+    without holding up the others.
+
+    Users must have logged in through the multiplexer's session.  Calls
+    should not wait on other calls submitted to the same multiplexer.
+    """
+
+    def __init__(self, session, concurrency=None, rate=None, burst=1, user_rate=None, user_burst=1,
+                 user_concurrency=None):
+        self.session = session
+        self.concurrency = concurrency or session._pool_size
+        self._limiter = RateLimiter(rate, burst) if rate else None
+        self._defaults = (user_rate, user_burst, user_concurrency)
+        self._accounts = {}
+        # users with calls waiting, per priority class, in the order they are served
+        self._ready = collections.defaultdict(collections.OrderedDict)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+        self.completed = collections.Counter()
+
+    def login(self, username, password):
+        return self.session.login(username, password)
+
+    def set_limits(self, user, rate=None, burst=1, concurrency=None):
+        """
+        Limits ``user`` to ``rate`` calls a second, in bursts of up to
+        ``burst``, and to ``concurrency`` calls at once.
+        """
+        with self._cond:
+            account = self._account(user)
+            account.limiter = RateLimiter(rate, burst) if rate else None
+            account.concurrency = concurrency
+            self._cond.notify_all()
+
+    def submit(self, user, fn, args=(), kwds=None, priority=NORMAL):
+        """
+        Queues ``fn(*args, **kwds)`` as a call made for ``user`` in the
+        priority class ``priority`` and returns a Future for its result.
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("the multiplexer has been closed")
+            key = user.access_token
+            self._account(user).queues[priority].append((future, fn, args, kwds or {}))
+            self._ready[priority][key] = True
+            if len(self._threads) < self.concurrency:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def pending(self, user=None):
+        """
+        Counts the calls waiting to run, for ``user`` or for everyone.
+        """
+        with self._cond:
+            if user is not None:
+                accounts = [self._accounts.get(user.access_token)]
+            else:
+                accounts = self._accounts.values()
+            return sum(len(q) for a in accounts if a for q in a.queues.values())
+
+    def close(self):
+        """
+        Lets the worker threads exit once the calls queued so far are done.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _account(self, user):
+        key = user.access_token
+        if key not in self._accounts:
+            rate, burst, concurrency = self._defaults
+            self._accounts[key] = _Account(rate, burst, concurrency)
+        return self._accounts[key]
+
+    def _next(self):
+        """
+        Takes the next call to run, or returns how long to wait before one
+        may be taken (None if there is nothing to wait for).
+        """
+        wait = None
+        for priority in sorted(self._ready):
+            ready = self._ready[priority]
+            for key in list(ready):
+                account = self._accounts[key]
+                if account.concurrency and account.running >= account.concurrency:
+                    continue
+                delay = account.limiter.try_acquire() if account.limiter else 0
+                if not delay and self._limiter:
+                    delay = self._limiter.try_acquire()
+                    if delay and account.limiter:
+                        account.limiter.refund()
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                queue = account.queues[priority]
+                work = queue.popleft()
+                # the user goes to the back of the line, or out of it
+                del ready[key]
+                if queue:
+                    ready[key] = True
+                account.running += 1
+                return key, work
+        return wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    taken = self._next()
+                    if isinstance(taken, tuple):
+                        break
+                    if self._closed and not any(self._ready.values()):
+                        return
+                    self._cond.wait(taken)
+            key, (future, fn, args, kwds) = taken
+            try:
+                future.set_result(fn(*args, **kwds))
+            except Exception as e:
+                future.set_exception(e)
+            with self._cond:
+                self._accounts[key].running -= 1
+                self.completed[key] += 1
+                self._cond.notify()
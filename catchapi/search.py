@@ -0,0 +1,142 @@
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''A local full-text index over a Catch account's notes'''
+
+import sqlite3, threading
+
+from catchapi import Note
+
+class SearchIndex(object):
+    """
+    A full-text index over the text, tags and comments of a user's notes,
+    kept in the SQLite database at ``path``.  That may be the database of a
+    SyncEngine, whose tables it leaves alone.
+
+    Notes are indexed with ``add``, or all at once with ``rebuild`` (say from
+    ``SyncEngine.notes()``).  Once attached to a session the index also
+    follows the notes that are fetched in full, posted, edited or deleted
+    through it.  ``search`` is answered from the index alone and returns
+    Note objects, comments included, without going to the server.
+    """
+
+    def __init__(self, user, path):
+        self.user = user
+        self.codec = user._session.codec
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS search_notes "
+                                "(id TEXT PRIMARY KEY, data TEXT NOT NULL, comments TEXT)")
+                self._fts5 = self._create_fts()
+
+    def _create_fts(self):
+        sql = "SELECT sql FROM sqlite_master WHERE name = 'search_fts'"
+        if self.db.execute(sql).fetchone() is None:
+            try:
+                self.db.execute("CREATE VIRTUAL TABLE search_fts USING fts5(text, tags, comments)")
+            except sqlite3.OperationalError:
+                # older SQLite builds only have fts4
+                self.db.execute("CREATE VIRTUAL TABLE search_fts USING fts4(text, tags, comments)")
+        return 'fts5' in self.db.execute(sql).fetchone()[0].lower()
+
+    def close(self):
+        self.db.close()
+
+    def attach(self, session):
+        session.add_listener(self._on_notes)
+
+    def detach(self, session):
+        session.remove_listener(self._on_notes)
+
+    def _on_notes(self, event, notes):
+        notes = [n for n in notes if n._user.access_token == self.user.access_token]
+        if event == 'deleted':
+            self.remove([n['id'] for n in notes])
+        else:
+            self.add(notes)
+
+    def add(self, notes):
+        """
+        Indexes ``notes``, or indexes them again if they have changed.  Their
+        comments are indexed too if they have been fetched.
+        """
+        with self._lock:
+            with self.db:
+                for note in notes:
+                    self._add(note)
+
+    def remove(self, ids):
+        with self._lock:
+            with self.db:
+                for id in ids:
+                    row = self.db.execute("SELECT rowid FROM search_notes WHERE id = ?", (id,)).fetchone()
+                    if row is not None:
+                        self.db.execute("DELETE FROM search_fts WHERE rowid = ?", row)
+                        self.db.execute("DELETE FROM search_notes WHERE rowid = ?", row)
+
+    def rebuild(self, notes):
+        """
+        Replaces the whole index with ``notes``.
+        """
+        with self._lock:
+            with self.db:
+                self.db.execute("DELETE FROM search_fts")
+                self.db.execute("DELETE FROM search_notes")
+                for note in notes:
+                    self._add(note)
+
+    def _add(self, note):
+        row = self.db.execute("SELECT rowid, comments FROM search_notes WHERE id = ?",
+                              (note['id'],)).fetchone()
+        if hasattr(note, '_comments'):
+            comments = self.codec.dumps(note._comments)
+        else:
+            comments = row and row[1]
+        data = self.codec.dumps(note)
+        if row is None:
+            rowid = self.db.execute("INSERT INTO search_notes (id, data, comments) VALUES (?, ?, ?)",
+                                    (note['id'], data, comments)).lastrowid
+        else:
+            rowid = row[0]
+            self.db.execute("UPDATE search_notes SET data = ?, comments = ? WHERE rowid = ?",
+                            (data, comments, rowid))
+            self.db.execute("DELETE FROM search_fts WHERE rowid = ?", (rowid,))
+        self.db.execute("INSERT INTO search_fts (rowid, text, tags, comments) VALUES (?, ?, ?, ?)",
+                        (rowid, note.get('text') or '', ' '.join(note.get('tags') or ()),
+                         ' '.join(c.get('text') or '' for c in self.codec.loads(comments or '[]'))))
+
+    def search(self, query, limit=20):
+        """
+        Returns up to ``limit`` notes matching ``query``, in SQLite full-text
+        query syntax, best matches first where SQLite can rank them.
+        """
+        order = "search_fts.rank" if self._fts5 else "search_notes.rowid DESC"
+        with self._lock:
+            rows = self.db.execute("SELECT search_notes.data, search_notes.comments "
+                                   "FROM search_fts JOIN search_notes ON search_notes.rowid = search_fts.rowid "
+                                   "WHERE search_fts MATCH ? ORDER BY %s LIMIT ?" % order,
+                                   (query, limit)).fetchall()
+        notes = []
+        for data, comments in rows:
+            note = Note(self.user, self.user._session, self.codec.loads(data))
+            if comments is not None:
+                note._comments = self.codec.loads(comments)
+            notes.append(note)
+        return notes
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT count(*) FROM search_notes").fetchone()[0]
@@ -0,0 +1,214 @@
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''Keeps a local SQLite mirror of a Catch account up to date'''
+
+import sqlite3
+
+from catchapi import Note
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (
+    id TEXT PRIMARY KEY,
+    server_modified_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media (
+    id TEXT,
+    note_id TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (note_id, id)
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id TEXT PRIMARY KEY,
+    note_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_note_id ON comments (note_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS sync_seen (
+    id TEXT PRIMARY KEY
+);
+'''
+
+class SyncEngine(object):
+    """
+    Mirrors a user's notes, media metadata and comments into the SQLite
+    database at ``path``.
+
+    A sync walks the account's note summaries, which carry little more than
+    each note's id and ``server_modified_at``, and fetches in full only the
+    notes that are new or have changed since they were stored.  Stored notes
+    that no longer appear in the listing are deleted.  Each page is written
+    in a transaction of its own together with the sync's position, so an
+    interrupted sync carries on from there the next time it is run.
+
+    The API can't list only the notes modified since a given time, so every
+    sync walks all of the summaries, however few notes have changed.  Notes
+    added or deleted on the server while a sync walks the listing shift it,
+    so that some notes may be missed; such a sync deletes nothing, leaving
+    that and the missed notes to the next one.
+    """
+
+    def __init__(self, user, path, page_size=100, comments=True):
+        self.user = user
+        self.codec = user._session.codec
+        self.page_size = page_size
+        self.comments = comments
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @property
+    def high_water_mark(self):
+        """
+        The highest ``server_modified_at`` of any note seen by the last sync.
+        It is kept for callers' information and doesn't narrow the next sync,
+        since the API has no way to list only the notes modified since then.
+        """
+        return self._state('high_water_mark')
+
+    def sync(self):
+        """
+        Brings the local copy up to date and returns a dict counting the notes
+        that were added, updated, deleted and left unchanged.
+        """
+        stats = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        session = self.user._session
+        offset = int(self._state('cursor') or 0)
+        summaries, count = self.user.get_notes(offset, self.page_size, full=False)
+        if offset and self._state('count') != str(count):
+            # notes were added or removed since the sync was interrupted, which
+            # shifts the listing; walk it again so nothing is skipped
+            offset = 0
+            summaries, count = self.user.get_notes(0, self.page_size, full=False)
+        expected = count
+        shifted = False
+        with self.db:
+            if offset == 0:
+                # including when a resumed sync starts over, whose ids may since have been deleted
+                self.db.execute("DELETE FROM sync_seen")
+            self._set_state('count', count)
+            self._set_state('cursor', offset)
+
+        while True:
+            following = None
+            if offset + self.page_size < count:
+                following = session._submit(self.user.get_notes, offset + self.page_size,
+                                            self.page_size, False)
+            self._sync_page(offset, summaries, stats)
+            offset += self.page_size
+            if following is None:
+                break
+            summaries, count = following.result()
+            if count != expected:
+                shifted = True
+
+        with self.db:
+            if not shifted:
+                deleted = [row[0] for row in self.db.execute(
+                    "SELECT id FROM notes WHERE id NOT IN (SELECT id FROM sync_seen)")]
+                for id in deleted:
+                    self._delete(id)
+                stats['deleted'] = len(deleted)
+            hwm = self.db.execute("SELECT max(server_modified_at) FROM notes").fetchone()[0]
+            self._set_state('high_water_mark', hwm)
+            self.db.execute("DELETE FROM sync_state WHERE key IN ('cursor', 'count')")
+            self.db.execute("DELETE FROM sync_seen")
+        return stats
+
+    def get_note(self, id):
+        """
+        Returns the stored note ``id``, with its comments, or None.
+        """
+        row = self.db.execute("SELECT data FROM notes WHERE id = ?", (id,)).fetchone()
+        return row and self._note(row[0])
+
+    def notes(self):
+        """
+        Iterates over every stored note, most recently modified first.
+        """
+        for (data,) in self.db.execute("SELECT data FROM notes ORDER BY server_modified_at DESC"):
+            yield self._note(data)
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM notes").fetchone()[0]
+
+    def _note(self, data):
+        note = Note(self.user, self.user._session, self.codec.loads(data))
+        if self.comments:
+            note._comments = [self.codec.loads(c) for (c,) in self.db.execute(
+                "SELECT data FROM comments WHERE note_id = ?", (note['id'],))]
+        return note
+
+    def _sync_page(self, offset, summaries, stats):
+        ids = [n['id'] for n in summaries]
+        stored = dict(self.db.execute("SELECT id, server_modified_at FROM notes WHERE id IN (%s)" %
+                                      ",".join("?" * len(ids)), ids)) if ids else {}
+        changed = [n['id'] for n in summaries if stored.get(n['id'], False) != n.get('server_modified_at')]
+        stats['unchanged'] += len(ids) - len(changed)
+
+        notes = self._fetch(offset, changed)
+        comments = {}
+        if self.comments:
+            session = self.user._session
+            pending = [(note, session._submit(lambda note: note.comments, note)) for note in notes]
+            comments = dict((note['id'], f.result()) for (note, f) in pending)
+
+        with self.db:
+            for note in notes:
+                stats['updated' if note['id'] in stored else 'added'] += 1
+                self._store(note, comments.get(note['id']))
+            self.db.executemany("INSERT OR IGNORE INTO sync_seen (id) VALUES (?)", [(id,) for id in ids])
+            self._set_state('cursor', offset + self.page_size)
+
+    def _fetch(self, offset, ids):
+        if not ids:
+            return []
+        notes = []
+        if len(ids) > self.page_size / 4:
+            # cheaper to fetch the whole page again than each note on its own
+            wanted = set(ids)
+            notes = [n for n in self.user.get_notes(offset, self.page_size)[0] if n['id'] in wanted]
+            ids = wanted.difference(n['id'] for n in notes)
+        session = self.user._session
+        notes.extend([f.result() for f in [session._submit(self.user.get_note, id) for id in ids]])
+        return notes
+
+    def _store(self, note, comments):
+        self.db.execute("INSERT OR REPLACE INTO notes (id, server_modified_at, data) VALUES (?, ?, ?)",
+                        (note['id'], note.get('server_modified_at'), self.codec.dumps(note)))
+        self.db.execute("DELETE FROM media WHERE note_id = ?", (note['id'],))
+        self.db.executemany("INSERT INTO media (id, note_id, data) VALUES (?, ?, ?)",
+                            [(m['id'], note['id'], self.codec.dumps(m)) for m in note.get('media', ())])
+        if comments is not None:
+            self.db.execute("DELETE FROM comments WHERE note_id = ?", (note['id'],))
+            self.db.executemany("INSERT INTO comments (id, note_id, data) VALUES (?, ?, ?)",
+                                [(c['id'], note['id'], self.codec.dumps(c)) for c in comments])
+
+    def _delete(self, id):
+        for table, column in (('notes', 'id'), ('media', 'note_id'), ('comments', 'note_id')):
+            self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (id,))
+
+    def _state(self, key):
+        row = self.db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row and row[0]
+
+    def _set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
@@ -0,0 +1,286 @@
+# Copyright 2011 Catch.com, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+'''An in-process stand-in for the Catch API, for benchmarks and offline tests'''
+
+import BaseHTTPServer, SocketServer, datetime, itertools, random, re, socket, sys, threading, time, urlparse, zlib
+import simplejson as json
+
+class FakeAccount(object):
+    """
+    The notes, media and comments of the fake server's one account, which
+    starts out with ``notes`` notes of ``payload`` characters of text each.
+    """
+
+    def __init__(self, notes=1000, payload=200):
+        self.payload = payload
+        self.notes = {}
+        self.comments = {}
+        self.media = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        for i in range(notes):
+            self.new_note(self.text(i))
+
+    def text(self, i):
+        text = "note %d #tag%d " % (i, i % 7)
+        return (text * (self.payload // len(text) + 1))[:self.payload]
+
+    def _stamp(self):
+        # a millisecond apart, so every write moves server_modified_at on
+        seq = next(self._ids)
+        stamp = datetime.datetime(2011, 1, 1) + datetime.timedelta(milliseconds=seq)
+        return seq, stamp.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (stamp.microsecond // 1000)
+
+    def tags(self, text):
+        # like the real service, a note is tagged with the #hashtags in its text
+        return sorted(set(re.findall(r"#(\w+)", text)))
+
+    def new_note(self, text, **fields):
+        seq, stamp = self._stamp()
+        note = {"id": "%d" % seq, "text": text, "summary": text[:40], "tags": self.tags(text),
+                "media": [], "created_at": stamp, "modified_at": stamp,
+                "server_modified_at": stamp, "browser_url": "https://catch.com/m/%d" % seq}
+        note.update(fields)
+        self.notes[note['id']] = note
+        return note
+
+    def touch(self, note):
+        note['server_modified_at'] = note['modified_at'] = self._stamp()[1]
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # buffer the response and send it in one go, see handle_one_request
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle_one_request(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if not self.wfile.closed:
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _send_media(self, content):
+        start, end, status = 0, len(content) - 1, 200
+        ranges = self.headers.get("Range", "")
+        if ranges.startswith("bytes="):
+            first, _, last = ranges[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), end) if last else end
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(content))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(content)))
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if self.server.compress and len(body) >= 256 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        server = self.server
+        split = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(split.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else ""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update(urlparse.parse_qsl(body))
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.random() * server.jitter)
+        parts = split.path.strip("/").split("/")
+        if parts[-1].endswith(".json"):
+            parts[-1] = parts[-1][:-5]
+        with server.account.lock:
+            server.requests += 1
+            if method == "GET" and parts[:2] == ["v2", "media"] and len(parts) == 4:
+                content = server.account.media.get(parts[3])
+            else:
+                content = None
+                status, data = self._route(method, parts, params, body)
+        if content is not None:
+            self._send_media(content)
+        else:
+            self._reply(data, status)
+
+    def _route(self, method, parts, params, body):
+        account = self.server.account
+        if parts == ["v2", "user"]:
+            return 200, {"user": {"id": "1", "user_name": "bench", "email": "bench@example.com",
+                                  "access_token": "bench-token"}}
+        if parts == ["v1", "tags"]:
+            tags = {}
+            for note in account.notes.values():
+                for tag in note['tags']:
+                    tags[tag] = tags.get(tag, 0) + 1
+            return 200, {"tags": [{"name": name, "count": count, "modified": "2011-01-01T00:00:00.000Z"}
+                                  for name, count in sorted(tags.items())]}
+        if parts == ["v2", "notes"]:
+            if method == "POST":
+                fields = dict((k, v) for k, v in params.items() if k not in ("access_token", "text"))
+                if "tags" in fields:
+                    fields['tags'] = [tag.strip() for tag in fields['tags'].split(",") if tag.strip()]
+                return 200, {"notes": [account.new_note(params.get("text", ""), **fields)]}
+            ids = sorted(account.notes, key=int)
+            offset, limit = int(params.get("offset", 0)), int(params.get("limit", 20))
+            page = [account.notes[id] for id in ids[offset:offset + limit]]
+            if params.get("full") == "false":
+                page = [dict((k, n[k]) for k in ("id", "server_modified_at", "summary")) for n in page]
+            return 200, {"notes": page, "count": len(ids)}
+        if parts[:2] == ["v2", "notes"] and len(parts) == 3:
+            note = account.notes.get(parts[2])
+            if note is None:
+                return 404, {"status": "error", "message": "not found"}
+            if method == "GET":
+                return 200, {"notes": [note]}
+            if method == "DELETE":
+                del account.notes[note['id']]
+                account.comments.pop(note['id'], None)
+                return 200, {"status": "ok"}
+            if params.get("server_modified_at", note['server_modified_at']) != note['server_modified_at']:
+                return 409, {"status": "error", "message": "conflict"}
+            for key, value in params.items():
+                if key == "tags":
+                    note[key] = [tag.strip() for tag in value.split(",") if tag.strip()]
+                elif key not in ("access_token", "server_modified_at"):
+                    note[key] = value
+            if "text" in params and "tags" not in params:
+                note['tags'] = account.tags(note['text'])
+            account.touch(note)
+            return 200, {"notes": [note]}
+        if parts[:2] == ["v2", "media"] and len(parts) in (3, 4):
+            note = account.notes.get(parts[2])
+            if note is None:
+                return 404, {"status": "error", "message": "not found"}
+            if method == "DELETE":
+                note['media'] = [m for m in note['media'] if m['id'] != parts[-1]]
+                account.touch(note)
+                return 200, {"status": "ok"}
+            if method != "POST" or len(parts) != 3:
+                return 404, {"status": "error", "message": "not found"}
+            # keep the first part of the multipart body as the media's content
+            boundary = self.headers.get("Content-Type", "").partition("boundary=")[2]
+            content = body.split("--" + boundary)[1].partition("\r\n\r\n")[2][:-2] if boundary else body
+            media = {"id": "%d" % next(account._ids), "size": len(content)}
+            media['src'] = "http://%s:%d/v2/media/%s/%s" % (self.server.server_address + (parts[2], media['id']))
+            account.media[media['id']] = content
+            note['media'].append(media)
+            account.touch(note)
+            return 200, media
+        if parts[:2] == ["v2", "comments"] and len(parts) == 3:
+            if parts[2] not in account.notes:
+                return 404, {"status": "error", "message": "not found"}
+            comments = account.comments.setdefault(parts[2], [])
+            if method == "POST":
+                seq, stamp = account._stamp()
+                comment = {"id": "%d" % seq, "text": params.get("text", ""), "created_at": stamp}
+                comments.append(comment)
+                return 200, {"notes": [comment]}
+            return 200, {"notes": comments}
+        if parts[:2] == ["v2", "comment"] and len(parts) == 3:
+            for comments in account.comments.values():
+                comments[:] = [c for c in comments if c['id'] != parts[2]]
+            return 200, {"status": "ok"}
+        return 404, {"status": "error", "message": "no such endpoint"}
+
+class FakeCatchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server answering the Catch API endpoints the client uses
+    from a FakeAccount.  Every request is delayed by ``latency`` seconds
+    plus up to ``jitter`` seconds more.  Responses are gzipped for clients
+    that accept it unless ``compress`` is false.
+
+        server = FakeCatchServer(notes=1000, payload=200, latency=0.01)
+        server.start()
+        session = CatchSession(server.url)
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, notes=1000, payload=200, latency=0.0, jitter=0.0, compress=True,
+                 address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.compress = compress
+        self.account = FakeAccount(notes, payload)
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._connections = set()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on kept-alive connections are no concern
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def process_request(self, request, client_address):
+        self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # wake the threads still waiting on kept-alive connections
+        for request in list(self._connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
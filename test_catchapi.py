@@ -13,7 +13,11 @@
 #  limitations under the License.
 
 import simplejson as json
-import sys, unittest, catchapi, os
+import sys, unittest, catchapi, os, socket, tempfile, threading
+from catchapi.sync import SyncEngine
+from catchapi.search import SearchIndex
+from catchapi.multiplex import Multiplexer, INTERACTIVE, BACKGROUND
+from catchapi.export import Exporter
 from getpass import getpass
 
 class TestCatchAPI(unittest.TestCase):
@@ -102,3 +106,312 @@ class TestCatchAPI(unittest.TestCase):
         self.assertEquals(len(n.comments), 1)
         c.delete()
         n.delete()
+
+    def test_connection_pool(self):
+        # Verify that keep-alive connections are handed back to the pool and reused.
+        u = self.login()
+        u.get_notes()
+        u.get_notes()
+        self.assertEquals(len(self.api._pool._idle), 1)
+        self.api.close()
+        self.failIf(self.api._pool._idle)
+
+    def test_async_session(self):
+        # Verify that the async session runs calls in the background and resolves them to notes.
+        api = catchapi.AsyncCatchSession(self.__class__._api_host, concurrency=4)
+        u = api.login(self.__class__._username, self.__class__._password).result()
+        notes = [f.result() for f in [api.post_note(u, "async %d" % i) for i in range(4)]]
+        self.assertEquals([n['text'] for n in notes], ["async %d" % i for i in range(4)])
+        self.failUnless(list(api.notes(u)))
+        for f in [api.delete(n) for n in notes]:
+            f.result()
+        self.failUnless(all(n.deleted for n in notes))
+
+    def test_iter_notes(self):
+        # Verify that prefetching pages yields the same notes, in the same order, as fetching them one by one.
+        u = self.login()
+        sequential = [n['id'] for n in u.iter_notes(page_size=10, prefetch=0)]
+        prefetched = [n['id'] for n in u.iter_notes(page_size=10, prefetch=4)]
+        self.assertEquals(sequential, prefetched)
+        self.assertEquals(len(u.notes), len(prefetched))
+
+    def test_media_from_file_object(self):
+        # Verify uploading from an open file, reporting progress as the body is streamed.
+        u = self.login()
+        n = u.post_note(text="test_media_from_file_object")
+        sent = []
+        with open(os.path.join(os.path.dirname(__file__), 'catch_logo.png'), 'rb') as f:
+            m = n.add_media(f, progress=lambda done, total: sent.append((done, total)))
+        self.failUnless(sent)
+        self.assertEquals(sent[-1][0], sent[-1][1])
+        m.delete()
+        n.delete()
+
+    def test_bulk_notes(self):
+        # Verify bulk post, edit and delete, with results coming back in order.
+        u = self.login()
+        results = list(u.post_notes(["bulk %d" % i for i in range(10)], concurrency=4))
+        self.assertEquals([r.index for r in results], range(10))
+        self.failIf([r for r in results if r.error])
+        notes = [r.result for r in results]
+        results = list(u.edit_notes([(n, {'text': n['text'] + " edited"}) for n in notes], ordered=False))
+        self.assertEquals(sorted(r.index for r in results), range(10))
+        self.assertEquals(notes[0]['text'], "bulk 0 edited")
+        results = list(u.delete_notes(notes, rate=5))
+        self.failUnless(all(n.deleted for n in notes))
+
+    def test_note_cache(self):
+        # Verify that repeated reads are served from the cache and that edits invalidate it.
+        cache = catchapi.NoteCache(size=10, ttl=60)
+        self.api.cache = cache
+        u = self.login()
+        note = u.post_note("test cache")
+        u.get_note(note['id'])
+        u.get_note(note['id'])
+        self.assertEquals(cache.hits, 1)
+        note.edit(text="cache edited")
+        self.assertEquals(u.get_note(note['id'])['text'], "cache edited")
+        self.assertEquals(cache.invalidations, 1)
+        note.delete()
+
+    def test_sync(self):
+        # Verify that a second sync only picks up what changed since the first.
+        u = self.login()
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            engine = SyncEngine(u, path)
+            engine.sync()
+            self.assertEquals(len(engine), len(u.notes))
+            note = u.post_note("test_sync")
+            stats = engine.sync()
+            self.assertEquals(stats['added'], 1)
+            self.assertEquals(engine.get_note(note['id'])['text'], "test_sync")
+            note.delete()
+            self.assertEquals(engine.sync()['deleted'], 1)
+            engine.close()
+        finally:
+            os.remove(path)
+
+    def test_search_index(self):
+        # Verify that the index follows posts, edits and deletes made through the session.
+        u = self.login()
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            index = SearchIndex(u, path)
+            index.attach(self.api)
+            note = u.post_note("test_search_index zebra")
+            self.assertEquals([n['id'] for n in index.search('zebra')], [note['id']])
+            note.edit(text="test_search_index okapi")
+            self.failIf(index.search('zebra'))
+            note.delete()
+            self.failIf(index.search('okapi'))
+            index.close()
+        finally:
+            os.remove(path)
+
+    def test_stream_notes(self):
+        # Verify that streamed pages decode to the same notes as buffered ones.
+        u = self.login()
+        notes, count = u.get_notes(limit=50)
+        stream = u.stream_notes(limit=50)
+        self.assertEquals([n['id'] for n in stream], [n['id'] for n in notes])
+        self.assertEquals(stream.count, count)
+        self.assertEquals([n['id'] for n in u.iter_notes(stream=True)], [n['id'] for n in u.notes])
+
+    def test_note_media_wrapped_on_access(self):
+        # Verify that media are still handed out as Media objects through dict-style access.
+        u = self.login()
+        n = u.post_note(text="test_note_media_wrapped_on_access")
+        n.add_media(os.path.join(os.path.dirname(__file__), 'catch_logo.png'))
+        note = u.get_note(n['id'])
+        self.failUnless(all(isinstance(m, catchapi.Media) for m in note['media']))
+        self.failUnless(note['media'][0]._note is note)
+        n.delete()
+
+    def test_tags_cached(self):
+        # Verify that the tag list is reused until it expires or is refreshed.
+        u = self.login()
+        tags = u.tags
+        self.failUnless(u.tags is tags)
+        self.failIf(u.refresh_tags() is tags)
+        u.tags_ttl = 0
+        self.failIf(u.tags is tags)
+
+    def test_request_metrics(self):
+        # Verify that requests are reported to hooks and aggregated by endpoint template.
+        events = []
+        self.api.add_hook('post_request', events.append)
+        metrics = catchapi.RequestMetrics()
+        metrics.attach(self.api)
+        u = self.login()
+        note = u.post_note("test_request_metrics")
+        u.get_note(note['id'])
+        note.delete()
+        self.assertEquals([e.endpoint for e in events],
+                          ["/v2/user", "/v2/notes.json", "/v2/notes/{id}.json", "/v2/notes/{id}.json"])
+        self.failUnless(all(e.status == 200 and e.total > 0 for e in events))
+        self.assertEquals(metrics.export()["GET /v2/notes/{id}.json"]['count'], 1)
+
+    def test_deadline_and_hedging(self):
+        # Verify that GETs are hedged once enough latencies are known, and that deadlines are enforced.
+        self.api = session = catchapi.CatchSession(self.__class__._api_host, hedge=True)
+        u = self.login()
+        note = u.post_note("test_deadline_and_hedging")
+        for i in range(25):
+            self.assertEquals(u.get_note(note['id'])['id'], note['id'])
+        self.failIf(session._hedge_delay("/v2/notes/{id}.json") is None)
+        with session.deadline(0.0001):
+            self.assertRaises(socket.timeout, u.get_note, note['id'])
+        note.delete()
+
+    def test_compression(self):
+        # Verify that compressed responses and request bodies round-trip.
+        self.api = catchapi.CatchSession(self.__class__._api_host, compress_requests=True, compress_threshold=64)
+        u = self.login()
+        note = u.post_note("test_compression " * 100)
+        self.assertEquals(u.get_note(note['id'])['text'], "test_compression " * 100)
+        self.failUnless(any(n['id'] == note['id'] for n in u.iter_notes(stream=True)))
+        note.delete()
+
+    def test_media_download(self):
+        # Verify that media downloads in ranges, and that a cached copy is used the second time.
+        directory = tempfile.mkdtemp()
+        self.api.media_cache = catchapi.MediaCache(os.path.join(directory, 'cache'))
+        u = self.login()
+        n = u.post_note(text="test_media_download")
+        logo = os.path.join(os.path.dirname(__file__), 'catch_logo.png')
+        m = n.add_media(logo)
+        path = os.path.join(directory, 'logo.png')
+        m.download(path, chunk_size=1024)
+        self.assertEquals(open(path, 'rb').read(), open(logo, 'rb').read())
+        self.failUnless(self.api.media_cache.get(m._src))
+        results = list(u.download_media([m], directory))
+        self.assertEquals(open(results[0].result, 'rb').read(), open(logo, 'rb').read())
+        n.delete()
+
+    def test_prefetch_comments(self):
+        # Verify that prefetched comments are read without further requests.
+        u = self.login()
+        note = u.post_note("test_prefetch_comments")
+        note.add_comment(text="prefetched")
+        fetched = u.get_note(note['id'])
+        u.prefetch_comments([fetched])
+        events = []
+        self.api.add_hook('pre_request', events.append)
+        self.failUnless(any(c['text'] == "prefetched" for c in fetched.comments))
+        self.assertEquals(events, [])
+        self.api.remove_hook('pre_request', events.append)
+        note.delete()
+
+    def test_multiplexer(self):
+        # Verify that a multiplexer runs interactive calls first, and takes each priority's users in turn.
+        mux = Multiplexer(self.api, concurrency=1)
+        alice = self.login()
+        bob = catchapi.User(self.api, dict(alice, access_token=alice.access_token + "-bob"))
+        started, release, ran = threading.Event(), threading.Event(), []
+
+        def block():
+            started.set()
+            release.wait(10)
+
+        # hold the only worker while the other calls are queued
+        mux.submit(alice, block)
+        started.wait(10)
+        futures = [mux.submit(user, ran.append, (name,), priority=priority) for user, name, priority in [
+            (alice, "a1", BACKGROUND), (alice, "a2", BACKGROUND), (alice, "a3", BACKGROUND),
+            (bob, "b1", BACKGROUND), (bob, "b2", BACKGROUND),
+            (alice, "a-now", INTERACTIVE), (bob, "b-now", INTERACTIVE)]]
+        release.set()
+        for f in futures:
+            f.result(10)
+        self.assertEquals(ran, ["a-now", "b-now", "a1", "b1", "a2", "b2", "a3"])
+        self.failUnless(mux.submit(alice, alice.get_notes).result()[0])
+        self.assertEquals(mux.pending(), 0)
+        mux.close()
+
+    def test_coalescing(self):
+        # Verify that identical concurrent reads share a request and still get a result each.
+        u = self.login()
+        note = u.post_note("test_coalescing")
+        joined, sent, release = [], [], threading.Event()
+
+        def hold(event):
+            # keep the first read in its hook until the other seven have joined it
+            if event.coalesced:
+                joined.append(event)
+                if len(joined) == 7:
+                    release.set()
+            else:
+                release.wait(10)
+
+        def count(event):
+            if not event.coalesced:
+                sent.append(event)
+        self.api.add_hook('pre_request', hold)
+        self.api.add_hook('post_request', count)
+        coalesced = self.api.coalesced
+        futures = [self.api._submit(u.get_note, note['id']) for i in range(8)]
+        notes = [f.result() for f in futures]
+        self.api.remove_hook('pre_request', hold)
+        self.api.remove_hook('post_request', count)
+        self.failUnless(all(n['id'] == note['id'] for n in notes))
+        self.assertEquals(len(set(id(n) for n in notes)), 8)
+        self.assertEquals(self.api.coalesced - coalesced, 7)
+        self.assertEquals(len(sent), 1)
+        note.delete()
+
+    def test_export(self):
+        # Verify that an export writes one line per note and cleans up after itself.
+        u = self.login()
+        path = os.path.join(tempfile.mkdtemp(), 'export.ndjson')
+        stats = Exporter(u, path, page_size=50).run()
+        lines = open(path).read().splitlines()
+        self.assertEquals(len(lines), stats['notes'])
+        self.failUnless(all('comments' in json.loads(line) for line in lines))
+        self.failIf(os.path.exists(path + ".parts"))
+
+    def test_summary_notes(self):
+        # Verify that summary notes load their page in one go on first access of a missing field.
+        u = self.login()
+        notes, count = u.get_notes(0, 5, full=False)
+        self.failIf(any(n.hydrated for n in notes))
+        events = []
+        self.api.add_hook('pre_request', events.append)
+        notes[0]['text']
+        self.failUnless(all(n.hydrated for n in notes))
+        self.assertEquals(len(events), 1)
+        self.assertEquals(u.count_notes(), count)
+
+    def test_write_behind(self):
+        # Verify that edits made in a write-behind block are merged into one request, and that conflicts are raised.
+        u = self.login()
+        note = u.post_note("test_write_behind")
+        stale = u.get_note(note['id'])
+        events = []
+        with self.api.write_behind():
+            self.api.add_hook('pre_request', events.append)
+            note.edit(text="test_write_behind edited")
+            note.edit(tags="write-behind")
+            self.assertEquals(events, [])
+        self.api.remove_hook('pre_request', events.append)
+        self.assertEquals(len(events), 1)
+        self.assertEquals(note['text'], "test_write_behind edited")
+        try:
+            with self.api.write_behind():
+                note.edit(text="test_write_behind newer")
+                stale.edit(text="stale")
+            self.fail("expected a ConflictError")
+        except catchapi.ConflictError as e:
+            self.failUnless(e.note is stale)
+        self.assertEquals(u.get_note(note['id'])['text'], "test_write_behind newer")
+        note.delete()
+
+    def test_codec(self):
+        # Verify that a session can be given its own JSON codec, by name or as an object.
+        self.api = catchapi.CatchSession(self.__class__._api_host, codec="json")
+        self.assertEquals(self.api.codec.name, "json")
+        u = self.login()
+        notes, count = u.get_notes(0, 5)
+        self.assertEquals(len(list(u.stream_notes(0, 5))), len(notes))
+        self.api = catchapi.CatchSession(self.__class__._api_host, codec=catchapi.json_codec())
+        self.failUnless(self.api.codec.name in catchapi.JSON_BACKENDS)